@@ -0,0 +1,274 @@
+import copy
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from api.errors import DatabaseUnavailable, IncompleteHistory, retry_transient
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+def apply_update(state: dict, update: dict) -> dict:
+    """
+    Apply the subset of the Mongo update operators the API uses to a document
+    :param state: the document before the update
+    :param update: the update document, with $set, $push and $inc keys
+    :return: the document after the update
+    """
+    for key, value in update.get("$set", {}).items():
+        state[key] = value
+    for key, value in update.get("$push", {}).items():
+        state[key] = state.get(key, []) + [value]
+    for key, value in update.get("$inc", {}).items():
+        state[key] = state.get(key, 0) + value
+    return state
+
+
+class AuditLog:
+    """
+    Append-only log of the mutations, written in batches by a background thread so requests never wait on it.
+
+    The writer counts the events of every entity in the entities collection and stores a snapshot of the entity
+    every SNAPSHOT_INTERVAL events, so a replay only reads the latest snapshot before the requested time and the
+    events after it. A replay that still applies more than SNAPSHOT_INTERVAL events stores a snapshot too.
+
+    Events reach the collection up to a flush interval late, and much later when a batch is kept through an
+    outage. A snapshot therefore only covers events older than the horizon. An event written after the horizon
+    bumps the epoch of its entity, and snapshots of an older epoch are ignored: they may have been taken without it.
+    """
+    SNAPSHOT_INTERVAL = 50
+
+    def __init__(self, events, snapshots, entities, batch_size: int = 500, flush_interval: float = 1.0,
+                 max_queued: int = 100000, horizon: float = 300.0):
+        """
+        :param events: the collection of the audit events
+        :param snapshots: the collection of the entity snapshots
+        :param entities: the collection of the per-entity event counters and epochs
+        :param batch_size: the maximum number of events per insert_many
+        :param flush_interval: the maximum number of seconds an event waits in the queue
+        :param max_queued: the number of events kept while the database is unavailable, later events are dropped
+        :param horizon: the number of seconds after which an event is expected to be in the collection,
+        it covers the flush interval, the retries and the server selection timeout
+        """
+        self.events = events
+        self.snapshots = snapshots
+        self.entities = entities
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.horizon_ns = int(horizon * 1e9)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.last_seq = 0
+        # started by the first event, so processes that never write (tests, scripts) do not touch the collections
+        self.writer = None
+
+    def record(self, entity: str, action: str, update: dict, actor: str = None, created: bool = False):
+        """
+        Queue an audit event, returns immediately
+        :param entity: the mutated entity, e.g. mesken:<object id> or user:<tckn>
+        :param action: the DbWrapper method making the mutation
+        :param update: the update applied to the entity
+        :param actor: the tckn of the user making the mutation
+        :param created: True if the update creates the entity, a replay must start from such an event
+        """
+        with self.lock:
+            # the nanosecond sequence orders events within the millisecond precision of BSON dates
+            self.last_seq = max(self.last_seq + 1, time.time_ns())
+            seq = self.last_seq
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run, name="audit-writer", daemon=True)
+                self.writer.start()
+        try:
+            self.queue.put_nowait({
+                "entity": entity,
+                "ts": datetime.fromtimestamp(seq / 1e9, tz=timezone.utc),
+                "seq": seq,
+                "action": action,
+                "actor": actor,
+                "created": created,
+                "update": update,
+            })
+        except queue.Full:
+            logger.error("audit queue is full, dropping %s of %s", action, entity)
+
+    def close(self):
+        """
+        Flush the queued events and stop the writer thread
+        """
+        if self.writer is None:
+            return
+        self.queue.put(None)
+        self.writer.join()
+
+    def run(self):
+        try:
+            self.events.create_index([("entity", ASCENDING), ("ts", ASCENDING)])
+            self.snapshots.create_index([("entity", ASCENDING), ("epoch", ASCENDING), ("ts", ASCENDING)])
+        except PyMongoError:
+            logger.exception("could not create the audit indexes")
+
+        stopped = False
+        retry = []
+        while not stopped:
+            # a batch the database refused is written again, ahead of the events queued since
+            batch, retry = retry, []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopped = True
+                    break
+                batch.append(event)
+
+            if not batch:
+                continue
+            try:
+                self.write(batch)
+            except DatabaseUnavailable:
+                if stopped:
+                    logger.error("database unavailable on shutdown, dropping %d audit events", len(batch))
+                else:
+                    logger.warning("database unavailable, keeping %d audit events for the next flush", len(batch))
+                    retry = batch
+                    time.sleep(self.flush_interval)
+                continue
+            except Exception:
+                # losing the trail must never take the API down
+                logger.exception("dropping %d audit events", len(batch))
+                continue
+
+            try:
+                self.snapshot_due({event["entity"] for event in batch})
+            except Exception:
+                # the next batch of the entities or their next replay takes the snapshot
+                logger.exception("could not snapshot the audit entities")
+
+    @retry_transient()
+    def write(self, batch: list):
+        """
+        Insert the batch and count its events per entity.
+        Safe to retry: a retried insert skips the events already written, a retried count only brings
+        a snapshot or an epoch forward.
+        """
+        try:
+            # insert_many sets the _id of the events, so a retried batch cannot be written twice
+            self.events.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # only the events written before the connection dropped are duplicates
+            errors = e.details.get("writeErrors", [])
+            if e.details.get("writeConcernErrors") or any(i.get("code") != DUPLICATE_KEY for i in errors):
+                raise
+
+        # measured once the events are visible, anything older than the horizon may be missing from a snapshot
+        horizon = time.time_ns() - self.horizon_ns
+        late = {event["entity"] for event in batch if event["seq"] < horizon}
+        counts = Counter(event["entity"] for event in batch)
+        self.entities.bulk_write([
+            UpdateOne({"_id": entity}, {"$inc": {"sinceSnapshot": count, "epoch": int(entity in late)}}, upsert=True)
+            for entity, count in counts.items()
+        ], ordered=False)
+        if late:
+            logger.warning("audit events of %d entities arrived after the horizon, their snapshots are discarded",
+                           len(late))
+
+    def snapshot_due(self, entities: set):
+        """
+        Snapshot the entities with SNAPSHOT_INTERVAL events or more since their last snapshot
+        :param entities: the entities of the batch just written
+        """
+        due = self.entities.find({"_id": {"$in": list(entities)}, "sinceSnapshot": {"$gte": self.SNAPSHOT_INTERVAL}})
+        for counter in due:
+            entity = counter["_id"]
+            try:
+                horizon = time.time_ns() - self.horizon_ns
+                self.rebuild(entity, datetime.fromtimestamp(horizon / 1e9, tz=timezone.utc), snapshot_after=0)
+            except IncompleteHistory:
+                # created before the audit log, there is no state to snapshot
+                pass
+            # other workers may have counted events since the find, they count towards the next snapshot
+            self.entities.update_one({"_id": entity}, {"$inc": {"sinceSnapshot": -counter["sinceSnapshot"]}})
+
+    def epoch(self, entity: str) -> int:
+        counter = self.entities.find_one({"_id": entity}, {"epoch": 1})
+        return counter.get("epoch", 0) if counter is not None else 0
+
+    def replay(self, entity: str, ts: datetime):
+        """
+        Rebuild the state of an entity at a point in time
+        :param entity: the entity, e.g. mesken:<object id>
+        :param ts: the point in time
+        :return: the state of the entity, None if it did not exist yet.
+        IncompleteHistory if the entity was created before the audit log
+        """
+        return self.rebuild(entity, ts, snapshot_after=self.SNAPSHOT_INTERVAL)
+
+    def rebuild(self, entity: str, ts: datetime, snapshot_after: int):
+        """
+        Replay an entity from its latest valid snapshot before ts, and store a snapshot at the last replayed event
+        older than the horizon if more than snapshot_after events older than the horizon were applied
+        :return: the state of the entity at ts
+        """
+        # read before the events: an event written after this read bumps the epoch and discards the new snapshot
+        epoch = self.epoch(entity)
+        until = {"entity": entity, "ts": {"$lte": ts}}
+        snapshot = self.snapshots.find_one({**until, "epoch": epoch}, sort=[("ts", DESCENDING), ("seq", DESCENDING)])
+
+        query = until
+        state = None
+        if snapshot is not None:
+            state = snapshot["state"]
+            query = {"$and": [until, {"$or": [
+                {"ts": {"$gt": snapshot["ts"]}},
+                {"ts": snapshot["ts"], "seq": {"$gt": snapshot["seq"]}},
+            ]}]}
+
+        horizon = time.time_ns() - self.horizon_ns
+        settled = None
+        replayed = 0
+        events = self.events.find(query, {"ts": 1, "seq": 1, "created": 1, "update": 1})
+        for event in events.sort([("ts", ASCENDING), ("seq", ASCENDING)]):
+            if event["seq"] >= horizon:
+                if settled is None and replayed > snapshot_after:
+                    # later events may still be on their way, the snapshot stops before them
+                    self.store_snapshot(entity, last, copy.deepcopy(state), epoch)
+                    settled = last
+                replayed = -1
+            if state is None and not event.get("created"):
+                raise IncompleteHistory()
+            state = apply_update(state if state is not None else {}, event["update"])
+            last = event
+            if replayed >= 0:
+                replayed += 1
+
+        if settled is None and replayed > snapshot_after:
+            self.store_snapshot(entity, last, state, epoch)
+        return state
+
+    def store_snapshot(self, entity: str, event: dict, state: dict, epoch: int):
+        """
+        :param entity: the replayed entity
+        :param event: the last event applied to the state
+        :param state: the state of the entity after the event
+        :param epoch: the epoch of the entity when its events were read
+        """
+        try:
+            # concurrent replays of the same entity store the same snapshot once
+            self.snapshots.replace_one(
+                {"entity": entity, "epoch": epoch, "seq": event["seq"]},
+                {"entity": entity, "epoch": epoch, "ts": event["ts"], "seq": event["seq"], "state": state},
+                upsert=True,
+            )
+        except PyMongoError:
+            # the next replay reads the deltas again and retries
+            logger.warning("could not store the snapshot of %s", entity, exc_info=True)
@@ -1,455 +1,527 @@
 import jwt
 import os
-import time
+import logging
 from web3 import Web3
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from dotenv import load_dotenv, find_dotenv
-from fastapi.exceptions import HTTPException
 from datetime import datetime, timezone, timedelta
 from eth_account.messages import encode_defunct
-from collections import OrderedDict
-
-from functools import wraps
+from contextlib import contextmanager
 
 import pydantic
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 
+from api.audit import AuditLog
+from api.models import User, Mesken, SaleInfo, MaintenanceEntry
+from api.errors import (
+    BadRequest, InvalidToken, InvalidCredentials, UserNotFound, MeskenNotFound, UserAlreadyExists, IncompleteHistory,
+    retry_transient
+)
+
 pydantic.json.ENCODERS_BY_TYPE[ObjectId] = str
 
 load_dotenv(find_dotenv())
 
+logger = logging.getLogger(__name__)
+
+
+def to_object_id(object_id: str) -> ObjectId:
+    """
+    :param object_id: the object id sent by the client
+    :return: the ObjectId, BadRequest if it is malformed
+    """
+    try:
+        return ObjectId(object_id)
+    except (InvalidId, TypeError) as e:
+        raise BadRequest("Invalid object id: %s" % object_id) from e
+
 
 class DbWrapper:
+    # listings and analytics tolerate replication lag, existence checks guard writes and stay on the primary.
+    # get_mesken reads from a secondary too, inside a causal session so its owner still sees their own writes.
+    READ_PREFERENCES = {
+        "get_users": ReadPreference.SECONDARY_PREFERRED,
+        "get_meskens": ReadPreference.SECONDARY_PREFERRED,
+        "get_meskens_etag": ReadPreference.SECONDARY_PREFERRED,
+        "get_mesken": ReadPreference.SECONDARY_PREFERRED,
+        "get_mesken_etag": ReadPreference.SECONDARY_PREFERRED,
+        "user_exists": ReadPreference.PRIMARY,
+        "user_exists_by_tckn": ReadPreference.PRIMARY,
+    }
+
     def __init__(self):
         self.setup()
 
-    def setup(self) -> bool:
+    def setup(self):
         """
-        :return: True if connected to the MongoDB, Error otherwise
+        Create the MongoDB client, the connection itself is opened lazily
         """
-        try:
-            self.connection_string = os.environ.get("MONGODB_PWD")
-            self.client = MongoClient(self.connection_string)
-            self.web3 = Web3()
-
-        except Exception as e:
-            print(e)
-            return e
+        self.connection_string = os.environ.get("MONGODB_PWD")
+        self.client = MongoClient(self.connection_string)
+        self.web3 = Web3()
+        self.audit = AuditLog(
+            self.get_collection("auditEvents"), self.get_collection("auditSnapshots"),
+            self.get_collection("auditEntities"),
+        )
 
+    @retry_transient()
     def get_database_names(self):
         """
         :return: a list of all the database names
         """
-        try:
-            dbs = self.client.list_database_names()
-            return dbs
-
-        except Exception as e:
-            print(e)
-            return e
+        return self.client.list_database_names()
 
     def get_database(self, db_name: str):
         """
         :param db_name: the name of the database to get
         :return: the database object
         """
-        try:
-            db = self.client[db_name]
-            return db
-
-        except Exception as e:
-            print(e)
-            return e
+        return self.client[db_name]
 
+    @retry_transient()
     def get_collections_names(self, db_name: str):
         """
         :param db_name: the name of the database to get the collections from
         :return: a list of all the collections in the database
         """
-        try:
-            db = self.get_database(db_name)
-            collections = db.list_collection_names()
-            return collections
-
-        except Exception as e:
-            print(e)
-            return e
+        db = self.get_database(db_name)
+        return db.list_collection_names()
 
-    def get_collection(self, collection_name: str):
+    def get_collection(self, collection_name: str, method: str = None, session=None):
         """
-        :param db_name: the name of the database to get the collection from
         :param collection_name: the name of the collection to get
+        :param method: the DbWrapper method reading from it, selects its read preference
+        :param session: the causal session the collection is used in, if any
         :return: the collection object
         """
+        db = self.get_database("medipoldao-digiathon")
+        collection = db[collection_name]
+        read_preference = self.READ_PREFERENCES.get(method, ReadPreference.PRIMARY)
+        if read_preference != ReadPreference.PRIMARY:
+            collection = collection.with_options(read_preference=read_preference)
+        if session is not None:
+            # causal consistency only holds for majority reads and writes
+            collection = collection.with_options(read_concern=ReadConcern("majority"),
+                                                 write_concern=WriteConcern("majority"))
+        return collection
+
+    @contextmanager
+    def causal_session(self, token: str = None, writes: bool = False):
+        """
+        Start a causally consistent session. With a token the session continues after the last
+        writing session of the same user, so reads routed to a secondary still see the user's own writes.
+        The times of the last write are kept in the causalTimes collection rather than in the process,
+        so the guarantee holds across workers and instances.
+        :param token: the JWT of the user, None for an anonymous session
+        :param writes: True if the session writes, its times are then stored for the user's next sessions
+        :return: the session
+        """
+        tckn = self.decode_token(token)["tckn"] if token else None
+        with self.client.start_session(causal_consistency=True) as session:
+            if tckn is not None:
+                times = self.get_causal_times(tckn)
+                if times is not None:
+                    if times.get("clusterTime") is not None:
+                        session.advance_cluster_time(times["clusterTime"])
+                    session.advance_operation_time(times["operationTime"])
+            yield session
+            if tckn is not None and writes and session.operation_time is not None:
+                self.set_causal_times(tckn, session.cluster_time, session.operation_time)
+
+    @retry_transient()
+    def get_causal_times(self, tckn: str):
+        """
+        :param tckn: the tckn of the user
+        :return: the clusterTime and operationTime of the user's last writing session, None if there is none
+        """
+        collection_name = "causalTimes"
+
+        # on the primary: a lagging secondary could return older times than the write just made
+        collection = self.get_collection(collection_name)
+        return collection.find_one({"_id": tckn})
+
+    def set_causal_times(self, tckn: str, cluster_time, operation_time):
+        """
+        Store the times of a writing session unless a later session of the user stored newer ones
+        """
+        collection_name = "causalTimes"
+
+        collection = self.get_collection(collection_name)
         try:
-            db = self.get_database("medipoldao-digiathon")
-            collection = db[collection_name]
-            return collection
-
-        except Exception as e:
-            print(e)
-            return e
-
-    def set_user(self, user_info: dict):
-        """
-        :param user_info: the user info to set
+            collection.update_one(
+                {"_id": tckn, "operationTime": {"$lt": operation_time}},
+                {"$set": {"clusterTime": cluster_time, "operationTime": operation_time}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # the filter missed because newer times are stored, the upsert then collides with them
+            pass
+        except PyMongoError:
+            # the write itself succeeded, only the user's next read may come from a lagging secondary
+            logger.warning("could not store the causal times of %s", tckn, exc_info=True)
+
+    def set_user(self, user: User):
+        """
+        :param user: the user to set
         :return: the user id
         """
-        """
-        user_info = {
-            "tckn": "12345678901",
-            "nonce": 0
-        }
-        """
-        try:
-            if self.user_exists_by_tckn(user_info["tckn"]):
-                return HTTPException(status_code=400, detail="User already exists. Try updating it!")
-            collection_name = "users"
+        if self.user_exists_by_tckn(user.tckn):
+            raise UserAlreadyExists()
+        collection_name = "users"
 
-            collection = self.get_collection(collection_name)
-            user = collection.insert_one(user_info).inserted_id
-            return user
+        collection = self.get_collection(collection_name)
+        user_doc = user.to_bson()
+        user_id = collection.insert_one(user_doc).inserted_id
 
-        except Exception as e:
-            print(e)
-            return e
+        user_doc.pop("password", None)
+        self.audit.record("user:" + user.tckn, "set_user", {"$set": user_doc}, user.tckn, created=True)
+        return user_id
 
-    def user_exists_by_tckn(self, user_tckn: str):
+    @retry_transient()
+    def user_exists_by_tckn(self, user_tckn: str) -> bool:
         """
         :return: True if the user exists, False otherwise
-        :param user_public_address: the public address of the user to check
+        :param user_tckn: the tckn of the user to check
         """
-        try:
-            collection_name = "users"
-
-            collection = self.get_collection(collection_name)
-            user = collection.find_one({
-                "tckn": user_tckn
-            })
-            return user is not None
+        collection_name = "users"
 
-        except Exception as e:
-            print(e)
-            return e
+        collection = self.get_collection(collection_name, "user_exists_by_tckn")
+        user = collection.find_one({
+            "tckn": user_tckn
+        }, User.EXISTS_PROJECTION)
+        return user is not None
 
+    @retry_transient()
     def user_exists(self, user_public_address: str) -> bool:
         """
         :return: True if the user exists, False otherwise
         :param user_public_address: the public address of the user to check
         """
-        try:
-            collection_name = "users"
+        collection_name = "users"
 
-            collection = self.get_collection(collection_name)
-            user = collection.find_one({
-                "publicAddress": user_public_address
-            })
-            return user is not None
-
-        except Exception as e:
-            print(e)
-            return e
+        collection = self.get_collection(collection_name, "user_exists")
+        user = collection.find_one({
+            "publicAddress": user_public_address
+        }, User.EXISTS_PROJECTION)
+        return user is not None
 
+    @retry_transient()
     def update_user_public_address(self, user_public_address: str, tckn: str):
         """
         Set user public address to user_public_address by finding the user by its tckn
         """
-        try:
-            if self.user_exists_by_tckn(tckn):
-                collection_name = "users"
-                collection = self.get_collection(collection_name)
-
-                collection.update_one({
-                    "tckn": tckn
-                }, {
-                    "$set": {
-                        "publicAddress": user_public_address
-                    }
-                })
-                return {
-                    "message": "User public address updated successfully"
-                }
-            else:
-                return {
-                    "message": "User does not exist"
-                }
-
-        except Exception as e:
-            print(e)
-            return e
+        collection_name = "users"
+        collection = self.get_collection(collection_name)
+
+        update = {
+            "$set": {
+                "publicAddress": user_public_address
+            }
+        }
+        result = collection.update_one({
+            "tckn": tckn
+        }, update)
+        if result.matched_count == 0:
+            raise UserNotFound()
+        self.audit.record("user:" + tckn, "update_user_public_address", update, tckn)
+        return {
+            "message": "User public address updated successfully"
+        }
 
+    @retry_transient()
     def user_check(self, user_public_address: str):
         """
         :param user_public_address: the user public address
         :return: the user if exists
         """
-        try:
-            collection_name = "users"
+        collection_name = "users"
 
-            collection = self.get_collection(collection_name)
-
-            if self.user_exists(user_public_address):
-                user = collection.find_one({"publicAddress": user_public_address})
-                if user:
-                    return HTTPException(status_code=200, detail={
-                        "message": "User retrieved successfully",
-                        "user": user
-                    })
-                else:
-                    return HTTPException(status_code=404, detail={
-                        "message": "User not found"
-                    })
-            else:
-                return HTTPException(status_code=404, detail={
-                    "message": "User not found"
-                })
-
-        except Exception as e:
-            print(e)
-            return
+        collection = self.get_collection(collection_name)
+        user = collection.find_one({"publicAddress": user_public_address}, User.PUBLIC_PROJECTION)
+        if not user:
+            raise UserNotFound()
+        return {
+            "message": "User retrieved successfully",
+            "user": User.from_bson(user).to_json()
+        }
 
+    @retry_transient()
     def update_user_nonce(self, user_public_address: str, nonce: int):
         """
         :param user_public_address: the public address of the user to update
         :param nonce: the nonce to set
-        :return: True if the user was updated, Error otherwise
+        :return: True if the user was updated
         """
-        try:
-            if self.user_exists(user_public_address):
-                collection_name = "users"
+        collection_name = "users"
 
-                collection = self.get_collection(collection_name)
-                collection.update_one({"publicAddress": user_public_address}, {"$set": {"nonce": nonce}})
-                return True
-            else:
-                return "Such user does not exist"
-
-        except Exception as e:
-            print(e)
-            return
+        collection = self.get_collection(collection_name)
+        result = collection.update_one({"publicAddress": user_public_address}, {"$set": {"nonce": nonce}})
+        if result.matched_count == 0:
+            raise UserNotFound()
+        return True
 
     def user_jwt(self, tckn: str):
+        if not self.user_exists_by_tckn(tckn):
+            raise UserNotFound()
+        token = jwt.encode(
+            {
+                "tckn": tckn,
+                "exp": datetime.now(tz=timezone.utc) + timedelta(days=7),
+            },
+            os.environ.get("SECRET"),
+            algorithm="HS256",
+        )
+
+        return {
+            "message": "User authenticated",
+            "token": token,
+        }
+
+    def decode_token(self, token: str) -> dict:
+        """
+        :param token: the JWT issued by user_jwt
+        :return: the decoded claims, InvalidToken if the token is malformed or expired
+        """
         try:
-            user_exists = self.user_exists_by_tckn(tckn)
-            if user_exists:
-                token = jwt.encode(
-                    {
-                        "tckn": tckn,
-                        "exp": datetime.now(tz=timezone.utc) + timedelta(days=7),
-                    },
-                    os.environ.get("SECRET"),
-                    algorithm="HS256",
-                )
-
-                return HTTPException(status_code=200, detail={
-                    "message": "User authenticated",
-                    "token": token,
-                })
-            else:
-                return HTTPException(status_code=404, detail={
-                    "message": "User not found"
-                })
-
-        except Exception as e:
-            print(e)
-            return e
+            claims = jwt.decode(token, os.environ.get("SECRET"), algorithms=["HS256"])
+        except jwt.PyJWTError as e:
+            raise InvalidToken() from e
+        if "tckn" not in claims:
+            raise InvalidToken()
+        return claims
 
     def verify(self, token: str):
-        try:
-            decoded = jwt.decode(token, os.environ.get("SECRET"), algorithms=["HS256"])
-            return HTTPException(status_code=200, detail={
-                "message": "User verified",
-                "user": decoded
-            })
-        except Exception as e:
-            print(e)
-            return e
+        return {
+            "message": "User verified",
+            "user": self.decode_token(token)
+        }
 
-    def login(self, tckn: str, password: str):
+    def authenticate(self, token: str) -> str:
         """
-        :return: True if the user exists, False otherwise
-        :param
+        :param token: the JWT of the user making the call
+        :return: the tckn of the user, UserNotFound if it was deleted since the token was issued
         """
-        try:
-            if not self.user_exists_by_tckn(tckn):
-                return HTTPException(status_code=400, detail="User does not exist!")
-
-            collection_name = "users"
+        userTCKN = self.decode_token(token)["tckn"]
+        if not self.user_exists_by_tckn(userTCKN):
+            raise UserNotFound()
+        return userTCKN
 
-            collection = self.get_collection(collection_name)
-            user = collection.find_one({
-                "tckn": tckn
-            })
+    @retry_transient()
+    def login(self, tckn: str, password: str):
+        """
+        :return: True if the password matches, InvalidCredentials otherwise
+        :param tckn: the tckn of the user
+        :param password: the password of the user
+        """
+        collection_name = "users"
 
-            if user["password"] == password:
-                return True
-            else:
-                return False
+        collection = self.get_collection(collection_name)
+        user = collection.find_one({
+            "tckn": tckn
+        }, User.LOGIN_PROJECTION)
 
-        except Exception as e:
-            print(e)
-            return e
+        if user is None:
+            raise UserNotFound()
+        if user["password"] != password:
+            raise InvalidCredentials()
+        return True
 
+    @retry_transient()
     def get_users(self):
         """
-        :param db_name: the name of the database to get the users from
-        :param collection_name: the name of the collection to get the users from
         :return: a list of all the users in the collection
         """
-        try:
+        collection_name = "users"
 
-            collection_name = "users"
-
-            collection = self.get_collection(collection_name)
-            users = collection.find()
-            users_list = [i for i in users]
-            return {i: users_list[i] for i in range(len(users_list))}
-
-        except Exception as e:
-            print(e)
-            return e
+        collection = self.get_collection(collection_name, "get_users")
+        users = collection.find({}, User.PUBLIC_PROJECTION)
+        users_list = [User.listing_json(i) for i in users]
+        return {i: users_list[i] for i in range(len(users_list))}
 
+    @retry_transient()
     def get_user_by_tckn(self, tckn: str):
         """
-        :param db_name: the name of the database to get the users from
-        :param collection_name: the name of the collection to get the users from
-        :return: a list of all the users in the collection
+        :param tckn: the tckn of the user
+        :return: the user
         """
-        try:
-
-            collection_name = "users"
+        collection_name = "users"
 
-            collection = self.get_collection(collection_name)
-            user = collection.find_one({
-                "tckn": tckn
-            })
-            return user
+        collection = self.get_collection(collection_name)
+        user = collection.find_one({
+            "tckn": tckn
+        }, User.PUBLIC_PROJECTION)
+        if not user:
+            raise UserNotFound()
+        return User.from_bson(user).to_json()
 
-        except Exception as e:
-            print(e)
-            return e
-
-    def set_mesken(self, mesken: str, token:str):
+    def set_mesken(self, mesken: Mesken, token:str):
         """
-        :param user_public_address: the public address of the user to update
         :param mesken: the mesken to set
-        :return: True if the user was updated, Error otherwise
+        :param token: the JWT of the owner
+        :return: the mesken id
         """
-        try:
-            decoded_user = self.verify(token)
-            userTCKN = decoded_user.detail["user"]["tckn"]
-            if not self.user_exists_by_tckn(userTCKN):
-                return HTTPException(status_code=400, detail="User does not exist!")
+        userTCKN = self.authenticate(token)
 
+        with self.causal_session(token, writes=True) as session:
             collection_name = "meskenlerim"
-            collection = self.get_collection(collection_name)
-            meskenId = collection.insert_one(mesken).inserted_id
+            collection = self.get_collection(collection_name, session=session)
+            mesken_doc = mesken.to_bson()
+            meskenId = collection.insert_one(mesken_doc, session=session).inserted_id
 
             collection_name = "users"
-            collection = self.get_collection(collection_name)
-            collection.update_one({"tckn": userTCKN}, {"$push": {"meskenlerim": {
+            collection = self.get_collection(collection_name, session=session)
+            user_update = {"$push": {"meskenlerim": {
                 "meskenId": meskenId,
                 "pay": "3000"
-            }}})
-            return meskenId
+            }}}
+            collection.update_one({"tckn": userTCKN}, user_update, session=session)
+            self.bump_meskens_version(session)
 
-        except Exception as e:
-            print(e)
-            return
+        self.audit.record("mesken:%s" % meskenId, "set_mesken", {"$set": mesken_doc}, userTCKN, created=True)
+        self.audit.record("user:" + userTCKN, "set_mesken", user_update, userTCKN)
+        return meskenId
 
-    def get_meskens(self):
+    @retry_transient()
+    def get_meskens(self, session=None):
         """
-        :param db_name: the name of the database to get the users from
-        :param collection_name: the name of the collection to get the users from
-        :return: a list of all the users in the collection
+        :param session: the causal session to read in
+        :return: a list of all the meskens, without their histories
         """
-        try:
-            collection_name = "meskenlerim"
-
-            collection = self.get_collection(collection_name)
-            collections = collection.find()
-            meskens_list = [i for i in collections]
-            return {i: meskens_list[i] for i in range(len(meskens_list))}
+        collection_name = "meskenlerim"
 
-        except Exception as e:
-            print(e)
-            return e
+        collection = self.get_collection(collection_name, "get_meskens", session)
+        collections = collection.find({}, Mesken.LISTING_PROJECTION, session=session)
+        meskens_list = [Mesken.listing_json(i) for i in collections]
+        return {i: meskens_list[i] for i in range(len(meskens_list))}
 
-    def get_mesken(self, meskenId):
+    @retry_transient()
+    def get_mesken(self, meskenId, session=None):
         """
-        :param db_name: the name of the database to get the users from
-        :param collection_name: the name of the collection to get the users from
-        :return: a list of all the users in the collection
+        :param meskenId: the object id of the mesken
+        :param session: the causal session to read in
+        :return: the mesken
         """
-        try:
-            collection_name = "meskenlerim"
-
-            collection = self.get_collection(collection_name)
-            mesken = collection.find_one({
-                "_id": ObjectId(meskenId)
-            })
-            return mesken
+        collection_name = "meskenlerim"
 
-        except Exception as e:
-            print(e)
-            return e
+        collection = self.get_collection(collection_name, "get_mesken", session)
+        mesken = collection.find_one({
+            "_id": to_object_id(meskenId)
+        }, session=session)
+        if not mesken:
+            raise MeskenNotFound()
+        return Mesken.from_bson(mesken).to_json()
 
-    def add_maintenance(self, meskenId:str,maintenance: str, token:str):
+    @retry_transient()
+    def get_mesken_etag(self, meskenId, session=None):
         """
-        :param user_public_address: the public address of the user to update
-        :param maintenance: the maintenance to set
-        :return: True if the user was updated, Error otherwise
+        :param meskenId: the object id of the mesken
+        :param session: the causal session to read in
+        :return: the weak ETag of the mesken, None if it does not exist
         """
-        try:
-            decoded_user = self.verify(token)
-            userTCKN = decoded_user.detail["user"]["tckn"]
-            if not self.user_exists_by_tckn(userTCKN):
-                return HTTPException(status_code=400, detail="User does not exist!")
+        collection_name = "meskenlerim"
 
-            # push maintance history to mesken  
-            collection_name = "meskenlerim"
-            collection = self.get_collection(collection_name)
-            collection.update_one({"_id": ObjectId(meskenId)}, {"$push": {"maintenanceHistory": {
-                maintenance
-            }}})
-            return True
+        collection = self.get_collection(collection_name, "get_mesken_etag", session)
+        mesken = collection.find_one({
+            "_id": to_object_id(meskenId)
+        }, Mesken.VERSION_PROJECTION, session=session)
+        if mesken is None:
+            return None
+        return 'W/"%s-%d"' % (mesken["_id"], mesken.get("version", 0))
 
-        except Exception as e:
-            print(e)
-            return
+    @retry_transient()
+    def get_meskens_etag(self, session=None):
+        """
+        :param session: the causal session to read in
+        :return: the weak ETag of the whole mesken collection
+        """
+        collection_name = "counters"
 
-    def put_on_sale(self, token: str, sale_info:dict):
-        try:
-            decoded_user = self.verify(token)
-            userTCKN = decoded_user.detail["user"]["tckn"]
-            if not self.user_exists_by_tckn(userTCKN):
-                return HTTPException(status_code=400, detail="User does not exist!")
+        # one document read, a revalidation must not scan the collection
+        collection = self.get_collection(collection_name, "get_meskens_etag", session)
+        counter = collection.find_one({"_id": "meskenlerim"}, {"version": 1}, session=session)
+        version = counter.get("version", 0) if counter is not None else 0
+        return 'W/"meskens-%d"' % version
 
-            collection_name = "meskenlerim"
-            collection = self.get_collection(collection_name)
-            collection.update_one({"_id": ObjectId(sale_info["meskenId"])}, {"$set": {"status": "2", "saleInfo": sale_info}})
-            return True
+    def bump_meskens_version(self, session):
+        """
+        Count a write to the mesken collection, every mesken write calls it in its session
+        :param session: the causal session of the write
+        """
+        collection_name = "counters"
 
-        except Exception as e:
-            print(e)
-            return
+        collection = self.get_collection(collection_name, session=session)
+        collection.update_one({"_id": "meskenlerim"}, {"$inc": {"version": 1}}, upsert=True, session=session)
 
-    def update_mesken(self, token: str, meskenObjectId:str, meskenTokenId: str, mesken_info:dict):
-        try:
-            decoded_user = self.verify(token)
-            userTCKN = decoded_user.detail["user"]["tckn"]
-            if not self.user_exists_by_tckn(userTCKN):
-                return HTTPException(status_code=400, detail="User does not exist!")
+    def add_maintenance(self, meskenId:str,maintenance: MaintenanceEntry, token:str):
+        """
+        :param meskenId: the object id of the mesken
+        :param maintenance: the maintenance to add
+        :param token: the JWT of the user
+        :return: True if the mesken was updated
+        """
+        userTCKN = self.authenticate(token)
 
+        # push maintance history to mesken
+        with self.causal_session(token, writes=True) as session:
             collection_name = "meskenlerim"
-            collection = self.get_collection(collection_name)
-            collection.update_one({"_id": ObjectId(meskenObjectId)}, {"$set": {"meskenId": meskenTokenId},
-            "$push": {"maintenanceHistory": {
-                mesken_info
-            }
-            }})
-            return True
-
-        except Exception as e:
-            print(e)
-            return
\ No newline at end of file
+            collection = self.get_collection(collection_name, session=session)
+            update = {"$push": {"maintenanceHistory": maintenance.to_bson()}, "$inc": {"version": 1}}
+            result = collection.update_one({"_id": to_object_id(meskenId)}, update, session=session)
+            if result.matched_count:
+                self.bump_meskens_version(session)
+        if result.matched_count == 0:
+            raise MeskenNotFound()
+        self.audit.record("mesken:%s" % to_object_id(meskenId), "add_maintenance", update, userTCKN)
+        return True
+
+    def put_on_sale(self, token: str, sale_info: SaleInfo):
+        userTCKN = self.authenticate(token)
+
+        with self.causal_session(token, writes=True) as session:
+            collection_name = "meskenlerim"
+            collection = self.get_collection(collection_name, session=session)
+            update = {"$set": {"status": "2", "saleInfo": sale_info.to_bson()}, "$inc": {"version": 1}}
+            result = collection.update_one({"_id": to_object_id(sale_info.meskenId)}, update, session=session)
+            if result.matched_count:
+                self.bump_meskens_version(session)
+        if result.matched_count == 0:
+            raise MeskenNotFound()
+        self.audit.record("mesken:%s" % to_object_id(sale_info.meskenId), "put_on_sale", update, userTCKN)
+        return True
+
+    def update_mesken(self, token: str, meskenObjectId:str, meskenTokenId: str, mesken_info: MaintenanceEntry):
+        userTCKN = self.authenticate(token)
+
+        with self.causal_session(token, writes=True) as session:
+            collection_name = "meskenlerim"
+            collection = self.get_collection(collection_name, session=session)
+            update = {"$set": {"meskenId": meskenTokenId},
+                      "$push": {"maintenanceHistory": mesken_info.to_bson()},
+                      "$inc": {"version": 1}}
+            result = collection.update_one({"_id": to_object_id(meskenObjectId)}, update, session=session)
+            if result.matched_count:
+                self.bump_meskens_version(session)
+        if result.matched_count == 0:
+            raise MeskenNotFound()
+        self.audit.record("mesken:%s" % to_object_id(meskenObjectId), "update_mesken", update, userTCKN)
+        return True
+
+    def get_mesken_at(self, meskenId: str, ts: datetime):
+        """
+        :param meskenId: the object id of the mesken
+        :param ts: the point in time
+        :return: the mesken as it was at ts
+        """
+        mesken_id = to_object_id(meskenId)
+        state = self.audit.replay("mesken:%s" % mesken_id, ts)
+        if state is None:
+            if mesken_id.generation_time <= ts:
+                # the mesken existed at ts, but the audit log has no event of it up to ts
+                raise IncompleteHistory()
+            raise MeskenNotFound()
+        state["_id"] = mesken_id
+        return Mesken.from_bson(state).to_json()
@@ -0,0 +1,84 @@
+import time
+import random
+from collections import Counter
+from functools import wraps
+
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+
+# number of failed requests per error class, served by /error_stats
+error_counts = Counter()
+
+
+class ApiError(Exception):
+    """
+    Base class of the errors the API reports to the client with a proper status code
+    """
+    status_code = 500
+    message = "Internal server error"
+
+    def __init__(self, message: str = None):
+        self.message = message or self.message
+        super().__init__(self.message)
+
+
+class BadRequest(ApiError):
+    status_code = 400
+    message = "Bad request"
+
+
+class InvalidToken(ApiError):
+    status_code = 401
+    message = "Invalid or expired token"
+
+
+class InvalidCredentials(ApiError):
+    status_code = 401
+    message = "Wrong TCKN or password"
+
+
+class UserNotFound(ApiError):
+    status_code = 404
+    message = "User not found"
+
+
+class MeskenNotFound(ApiError):
+    status_code = 404
+    message = "Mesken not found"
+
+
+class UserAlreadyExists(ApiError):
+    status_code = 409
+    message = "User already exists. Try updating it!"
+
+
+class IncompleteHistory(ApiError):
+    status_code = 404
+    message = "The audit log starts after this entity was created, its past state is unknown"
+
+
+class DatabaseUnavailable(ApiError):
+    status_code = 503
+    message = "Database is temporarily unavailable"
+
+
+def retry_transient(retries: int = 3, base_delay: float = 0.05):
+    """
+    Retry an idempotent call on transient Mongo errors with full-jitter exponential backoff.
+    Only use it on reads and on writes that can safely be applied twice. The backoff blocks the calling thread,
+    so the routes calling it are plain def routes running in the threadpool, never async def.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(retries + 1):
+                try:
+                    return func(*args, **kwargs)
+                except ServerSelectionTimeoutError as e:
+                    # the driver already waited for a server, retrying would only pile up requests
+                    raise DatabaseUnavailable() from e
+                except AutoReconnect as e:
+                    if attempt == retries:
+                        raise DatabaseUnavailable() from e
+                    time.sleep(random.uniform(0, base_delay * 2 ** attempt))
+        return wrapper
+    return decorator
@@ -1,8 +1,16 @@
-from fastapi import FastAPI, Request
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request, Response, Body
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
 from api.db_wrapper import DbWrapper
+from api.models import User, Mesken, SaleInfo, MaintenanceEntry
+from api.errors import ApiError, BadRequest, InvalidToken, error_counts
+from pymongo.errors import PyMongoError, ConnectionFailure
 
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 
 from web3 import Web3
 
@@ -21,8 +29,12 @@ middleware = [
         allow_origins=['*'],  # origins if domain is mentioned
         allow_credentials=True,
         allow_methods=['*'],
-        allow_headers=['*']
-    )
+        allow_headers=['*'],
+        expose_headers=['ETag']
+    ),
+    # only the listings are large enough to be worth compressing, level 1 keeps most of the saving at a fraction
+    # of the CPU time of the default level 9 (see benchmarks/bench_etag_gzip.py)
+    Middleware(GZipMiddleware, minimum_size=1024, compresslevel=1)
 ]
 
 app = FastAPI(middleware=middleware)
@@ -30,305 +42,317 @@ db = DbWrapper()
 web3 = Web3()
 
 
+@app.on_event("shutdown")
+def flush_audit_log():
+    db.audit.close()
+
+
+def error_response(error: Exception, status_code: int, message: str) -> JSONResponse:
+    error_counts[type(error).__name__] += 1
+    return JSONResponse(status_code=status_code, content={
+        "message": message
+    })
+
+
+@app.exception_handler(ApiError)
+async def api_error_handler(info: Request, error: ApiError):
+    return error_response(error, error.status_code, error.message)
+
+
+@app.exception_handler(RequestValidationError)
+async def invalid_body_handler(info: Request, error: RequestValidationError):
+    return error_response(error, 400, "Request body must be a JSON object")
+
+
+@app.exception_handler(PyMongoError)
+async def database_error_handler(info: Request, error: PyMongoError):
+    if isinstance(error, ConnectionFailure):
+        return error_response(error, 503, "Database is temporarily unavailable")
+    return error_response(error, 500, "Database error")
+
+
+@app.exception_handler(Exception)
+async def unhandled_error_handler(info: Request, error: Exception):
+    return error_response(error, 500, "Internal server error")
+
+
+def require(req: dict, *fields: str):
+    """
+    :param req: the request body
+    :param fields: the fields the route reads from it
+    :return: BadRequest if any of the fields is missing
+    """
+    missing = [field for field in fields if field not in req]
+    if missing:
+        raise BadRequest("Missing field: %s" % ", ".join(missing))
+
+
+def session_token(info: Request):
+    """
+    :return: the bearer token of the Authorization header if it is valid, None to read in an anonymous session
+    """
+    scheme, _, token = info.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        db.decode_token(token)
+    except InvalidToken:
+        # the reads are public, an expired token only loses read-your-writes
+        return None
+    return token
+
+
+def etag_matches(info: Request, etag: str) -> bool:
+    """
+    The ETags are weak because the gzip and identity responses share them, so If-None-Match uses weak comparison
+    :return: True if the If-None-Match header of the request contains the ETag
+    """
+    if not etag:
+        return False
+    if_none_match = info.headers.get("if-none-match", "").strip()
+    if if_none_match == "*":
+        return True
+    opaque_tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in opaque_tags
+
+
 @app.get("/")
 async def root(info: Request):
     """
     :return: a welcoming screen
     :return:
     """
-    try:
-        return "MedipolDAO Digiathon API"
-
-    except Exception as e:
-        return e
+    return "MedipolDAO Digiathon API"
 
 
 @app.get("/user_exists/")
-async def user_exists(info: Request) -> bool:
+def user_exists(info: Request, req: dict = Body(...)) -> bool:
     """
     :param tckn: TCKN of the user
     :return: a boolean indicating if the user exists
     """
-    try:
-        req = await info.json()
-        if req['tckn']:
-            exists = db.user_exists_by_tckn(req['tckn'])
+    require(req, 'tckn')
+    if not req['tckn']:
+        raise BadRequest("Please provide TCKN!")
+    exists = db.user_exists_by_tckn(req['tckn'])
 
-            return exists
-        else:
-            return {
-                "message": "Please provide TCKN!"
-            }
-
-    except Exception as e:
-        return e
+    return exists
 
 
 # Admin permission only should be added
 @app.get("/get_users")
-async def get_users(info: Request):
+def get_users(info: Request):
     """
     :return: a list of all the users
     """
-    try:
-        users = db.get_users()
-        return users
+    users = db.get_users()
+    # already encoded by User.listing_json, skip the jsonable_encoder pass
+    return JSONResponse(users)
 
-    except Exception as e:
-        return e
 
-@app.get("/get_meskens")
-async def get_meskens():
+# Admin permission only should be added
+@app.get("/error_stats")
+async def error_stats(info: Request):
     """
-    :return: meskens
+    :return: the number of failed requests per error class
     """
-    try:
-        meskens = db.get_meskens()
-        if meskens:
-            return meskens
-        else:
-            return {
-                "message": "You are not authorized to view this page"
-            }
+    return dict(error_counts)
 
-    except Exception as e:
-        return e
+@app.get("/get_meskens")
+def get_meskens(info: Request):
+    """
+    With an "Authorization: Bearer <JWT>" header the listing includes the user's own latest writes
+    :return: meskens, or 304 if the If-None-Match header matches the current ETag
+    """
+    # the ETag and the body are read in one causal session so the body is never older than the ETag
+    with db.causal_session(session_token(info)) as session:
+        etag = db.get_meskens_etag(session)
+        if etag_matches(info, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        meskens = db.get_meskens(session)
+    # already encoded by Mesken.listing_json, skip the jsonable_encoder pass
+    return JSONResponse(meskens, headers={"ETag": etag} if etag else None)
+
+@app.get('/get_mesken')
+def get_mesken(info: Request, response: Response, meskenId: str = None):
+    """
+    Conditional GET of one mesken.
+    With an "Authorization: Bearer <JWT>" header the mesken includes the user's own latest writes
+    :param meskenId: the object id of the mesken, in the query string
+    :return: mesken, or 304 if the If-None-Match header matches the current ETag
+    """
+    if not meskenId:
+        raise BadRequest("Missing field: meskenId")
+    with db.causal_session(session_token(info)) as session:
+        etag = db.get_mesken_etag(meskenId, session)
+        if etag_matches(info, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        mesken = db.get_mesken(meskenId, session)
+    if etag:
+        response.headers["ETag"] = etag
+    return mesken
 
 @app.post('/get_mesken')
-async def get_mesken(info: Request):
+def get_mesken_by_body(info: Request, req: dict = Body(...)):
     """
+    Kept for the clients sending the id in the body. POST is never revalidated, use GET /get_mesken for a 304.
+    With an "Authorization: Bearer <JWT>" header the mesken includes the user's own latest writes
     :return: mesken
     """
+    require(req, 'meskenId')
+    with db.causal_session(session_token(info)) as session:
+        mesken = db.get_mesken(req['meskenId'], session)
+    return mesken
+
+# Admin permission only should be added
+@app.post('/get_mesken_at')
+def get_mesken_at(info: Request, req: dict = Body(...)):
+    """
+    :param ts: ISO 8601 point in time, UTC if no offset is given
+    :return: the mesken as it was at ts, replayed from the audit log
+    """
+    require(req, "meskenId", "ts")
     try:
-        req = await info.json()
-        mesken = db.get_mesken(req['meskenId'])
-        if mesken:
-            return mesken
-        else:
-            return {
-                "message": "You are not authorized to view this page"
-            }
-
-    except Exception as e:
-        return e
+        ts = datetime.fromisoformat(req["ts"])
+    except (TypeError, ValueError):
+        raise BadRequest("ts must be an ISO 8601 date")
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return db.get_mesken_at(req["meskenId"], ts)
 
 @app.post('/add_maintenance')
-async def add_maintenance(info: Request):
+def add_maintenance(info: Request, req: dict = Body(...)):
     """
     :return: mesken
     """
-    try:
-        req = await info.json()
-        maintenance = db.add_maintenance(req['meskenId'], req['maintenance'], req["token"])
-        return maintenance
-
-    except Exception as e:
-        return e
+    require(req, 'meskenId', 'maintenance', 'token')
+    if not isinstance(req['maintenance'], dict):
+        raise BadRequest("maintenance must be an object with date, desc and price")
+    maintenance = db.add_maintenance(req['meskenId'], MaintenanceEntry.from_request(req['maintenance']), req["token"])
+    return maintenance
 
 @app.post('/put_on_sale')
-async def put_on_sale(info: Request):
-    try:
-        req = await info.json()
-        token = req["token"]
+def put_on_sale(info: Request, req: dict = Body(...)):
+    require(req, "token", "meskenId", "price", "amount")
+    token = req["token"]
 
-        sale_info = {
-            "meskenId": req["meskenId"],
-            "price": req["price"],
-            "amount": req["amount"],
-        }
+    sale_info = SaleInfo(req["meskenId"], req["price"], req["amount"])
 
-        user = db.put_on_sale(token, sale_info)
+    user = db.put_on_sale(token, sale_info)
 
-        return user
-
-    except Exception as e:
-        return e
+    return user
 
 # Admin permission only should be added
 @app.post("/get_user_by_tckn")
-async def get_user_by_tckn(info: Request):
+def get_user_by_tckn(info: Request, req: dict = Body(...)):
     """
     :return: a user by TCKN
     """
-    try:
-        req = await info.json()
-        if req["tckn"]:
-            user = db.get_user_by_tckn(req["tckn"])
-            return user
-        else:
-            return {
-                "message": "You are not authorized to view this page"
-            }
-
-    except Exception as e:
-        return e
+    require(req, "tckn")
+    if not req["tckn"]:
+        raise BadRequest("Please provide TCKN!")
+    user = db.get_user_by_tckn(req["tckn"])
+    return user
 
 
 # Admin permission only should be added
 @app.post("/get_user")
-async def get_user_by_public_address(info: Request):
+def get_user_by_public_address(info: Request, req: dict = Body(...)):
     """
     :return: a user by public address
     """
-    try:
-        req = await info.json()
-        if req["publicAddress"]:
-            user = db.get_user(req["publicAddress"])
-            return user
-        else:
-            return {
-                "message": "You are not authorized to view this page"
-            }
-
-    except Exception as e:
-        return e
+    require(req, "publicAddress")
+    if not req["publicAddress"]:
+        raise BadRequest("Please provide a public address!")
+    user = db.user_check(req["publicAddress"])
+    return user
 
 
 # Admin permission only should be added
 @app.post("/set_user")
-async def set_user(info: Request):
+def set_user(info: Request, req: dict = Body(...)):
     """
     :return: the user id
     """
-    try:
-        req = await info.json()
-        user_info = {
-            "tckn": req["tckn"],
-            "password": req["password"],
-            "publicAddress": "",
-            "name": req["name"],
-            "surname": req["surname"],
-            "nonce": 0,
-            "meskenlerim": [],
-        }
-        user_id = db.set_user(user_info)
-
-        return user_id
-
-    except Exception as e:
-        return e
+    require(req, *User.REQUEST_FIELDS)
+    user_id = db.set_user(User.from_request(req))
+
+    return user_id
 
 @app.post("/set_mesken")
-async def set_mesken(info: Request):
+def set_mesken(info: Request, req: dict = Body(...)):
     """
     :return: the mesken id
     """
-    try:
-        req = await info.json()
-        token = req["token"]
-        mesken_info = {
-            "meskenId": req["meskenId"],
-            "ilId": req["ilId"],
-            "parselId": req["parselId"],
-            "zeminId":req["zeminId"],
-            "parselNo" :req["parselNo"],
-            "mahalleId": req["mahalleId"],
-            "adaNo":req["adaNo"],
-            "ilceId": req["ilceId"],
-            "katNo": req["katNo"],
-            "kapiNo": req["kapiNo"],
-            "rayicFiyat": req["rayicFiyat"],
-            "pay": req["pay"],
-            "payda": req["payda"],
-            "status": req["status"],
-            "auctionInfo":{},
-            "saleHistory":[],
-            "saleInfo":{},
-            "maintenanceHistory":[],
-            "age": req["age"],
-            "tckn": req["tckn"],
-        }
-        mesken_id = db.set_mesken(mesken_info,token)
-
-        return mesken_id
-
-    except Exception as e:
-        return e
+    require(req, "token", *Mesken.REQUEST_FIELDS)
+    token = req["token"]
+    mesken_info = Mesken.from_request(req)
+    mesken_id = db.set_mesken(mesken_info,token)
+
+    return mesken_id
 
 
 @app.post("/update_public_address")
-async def update_public_address(info: Request):
+def update_public_address(info: Request, req: dict = Body(...)):
     """
     :return: the user id
     """
-    try:
-        req = await info.json()
+    require(req, "publicAddress", "tckn")
 
-        user_id = db.update_user_public_address(
-            user_public_address=req["publicAddress"],
-            tckn=req["tckn"]
-        )
-
-        return user_id
+    user_id = db.update_user_public_address(
+        user_public_address=req["publicAddress"],
+        tckn=req["tckn"]
+    )
 
-    except Exception as e:
-        return e
+    return user_id
 
 @app.post("/update_mesken")
-async def update_mesken(info: Request):
+def update_mesken(info: Request, req: dict = Body(...)):
     """
     :return: the mesken id
     """
-    try:
-        req = await info.json()
-        token = req["token"]
-        meskenObjectId= req["meskenObjectId"]
-        meskenTokenId= req["meskenTokenId"]
-        mesken_info = {
-            "date": req["date"],
-            "desc": req["desc"],
-            "price": req["price"],
-        }
-        mesken_id = db.update_mesken(token,meskenObjectId,meskenTokenId,mesken_info)
-
-        return mesken_id
+    require(req, "token", "meskenObjectId", "meskenTokenId", "date", "desc", "price")
+    token = req["token"]
+    meskenObjectId= req["meskenObjectId"]
+    meskenTokenId= req["meskenTokenId"]
+    mesken_info = MaintenanceEntry(req["date"], req["desc"], req["price"])
+    mesken_id = db.update_mesken(token,meskenObjectId,meskenTokenId,mesken_info)
 
-    except Exception as e:
-        return e
+    return mesken_id
 
 
 
 @app.post("/user_jwt")
-async def user_jwt(info: Request):
+def user_jwt(info: Request, req: dict = Body(...)):
     """
     :return: the user id
     """
-    try:
-        req = await info.json()
-
-        token = db.user_jwt(req["tckn"])
+    require(req, "tckn")
 
-        return token
+    token = db.user_jwt(req["tckn"])
 
-    except Exception as e:
-        return e
+    return token
 
 @app.post('/login')
-async def login(info: Request):
+def login(info: Request, req: dict = Body(...)):
     """
     :return: the user id
     """
-    try:
-        req = await info.json()
-
-        user = db.login(req["tckn"],req["password"])
+    require(req, "tckn", "password")
 
-        return user
+    user = db.login(req["tckn"],req["password"])
 
-    except Exception as e:
-        return e
+    return user
 
 @app.post('/verify')
-async def verify(info: Request):
+def verify(info: Request, req: dict = Body(...)):
     """
     :return: the user id
     """
-    try:
-        req = await info.json()
-
-        user = db.verify(req["token"])
+    require(req, "token")
 
-        return user
+    user = db.verify(req["token"])
 
-    except Exception as e:
-        return e
\ No newline at end of file
+    return user
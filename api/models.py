@@ -0,0 +1,307 @@
+import logging
+from dataclasses import dataclass, field, fields
+from typing import ClassVar, Optional
+
+from bson.objectid import ObjectId
+
+logger = logging.getLogger(__name__)
+
+
+class _Missing:
+    """
+    The value of a field the document does not have, a stored null stays None
+    """
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+
+
+def _str_id(object_id):
+    return str(object_id) if object_id is not None else None
+
+
+def _document(cls):
+    # document key -> field name, the id field is stored as _id
+    cls.KEYS = {("_id" if i.name == "id" else i.name): i.name for i in fields(cls) if i.name != "extras"}
+    return cls
+
+
+def _from_bson(cls, doc: dict, **converters):
+    """
+    :param doc: the document, possibly projected
+    :param converters: field name -> function building the field from the stored value
+    :return: the model, fields the document does not have are MISSING, keys outside the model go to extras
+    """
+    values = {}
+    extras = {}
+    for key, value in doc.items():
+        name = cls.KEYS.get(key)
+        if name is None:
+            extras[key] = value
+        elif name in converters:
+            values[name] = converters[name](value)
+        else:
+            values[name] = value
+    return cls(extras=extras, **values)
+
+
+def _to_bson(model, **converted) -> dict:
+    """
+    :param converted: field name -> the stored value of the field, for the fields that are not stored as is
+    :return: the fields the model has, then the keys outside the model
+    """
+    doc = {}
+    for key, name in model.KEYS.items():
+        value = converted[name] if name in converted else getattr(model, name)
+        if value is not MISSING:
+            doc[key] = value
+    doc.update(model.extras)
+    return doc
+
+
+@_document
+@dataclass(slots=True)
+class MaintenanceEntry:
+    KEYS: ClassVar[dict] = {}
+
+    date: Optional[str] = MISSING
+    desc: Optional[str] = MISSING
+    price: Optional[str] = MISSING
+    extras: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_request(cls, req: dict):
+        """
+        :param req: the maintenance object of the /add_maintenance request body
+        :return: the maintenance entry, only the date, desc and price of the request are stored
+        """
+        return cls(req.get("date"), req.get("desc"), req.get("price"))
+
+    @classmethod
+    def from_bson(cls, doc: dict):
+        """
+        :param doc: the maintenance entry as stored in the maintenanceHistory array
+        :return: the maintenance entry
+        """
+        return _from_bson(cls, doc)
+
+    def to_bson(self) -> dict:
+        return _to_bson(self)
+
+
+def _maintenance_entry(mesken_id, entry):
+    if isinstance(entry, dict):
+        return MaintenanceEntry.from_bson(entry)
+    # written before maintenance entries were typed, kept as is rather than dropped
+    logger.warning("mesken %s has a malformed maintenance entry: %r", mesken_id, entry)
+    return entry
+
+
+@_document
+@dataclass(slots=True)
+class SaleInfo:
+    KEYS: ClassVar[dict] = {}
+
+    meskenId: Optional[str] = MISSING
+    price: Optional[str] = MISSING
+    amount: Optional[str] = MISSING
+    extras: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_bson(cls, doc: dict):
+        """
+        :param doc: the saleInfo sub-document of a mesken
+        :return: the sale info, None if the mesken is not on sale
+        """
+        if not doc:
+            return None
+        return _from_bson(cls, doc)
+
+    def to_bson(self) -> dict:
+        return _to_bson(self)
+
+
+@_document
+@dataclass(slots=True)
+class User:
+    # the password is only ever fetched by login
+    PUBLIC_PROJECTION: ClassVar[dict] = {"password": 0}
+    LOGIN_PROJECTION: ClassVar[dict] = {"password": 1}
+    EXISTS_PROJECTION: ClassVar[dict] = {"_id": 1}
+    REQUEST_FIELDS: ClassVar[tuple] = ("tckn", "password", "name", "surname")
+    KEYS: ClassVar[dict] = {}
+
+    id: Optional[ObjectId] = MISSING
+    tckn: Optional[str] = MISSING
+    password: Optional[str] = MISSING
+    publicAddress: Optional[str] = MISSING
+    name: Optional[str] = MISSING
+    surname: Optional[str] = MISSING
+    nonce: Optional[int] = MISSING
+    meskenlerim: Optional[list] = MISSING
+    extras: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_request(cls, req: dict):
+        """
+        :param req: the /set_user request body
+        :return: a new user without any mesken
+        """
+        return cls(
+            tckn=req["tckn"],
+            password=req["password"],
+            publicAddress="",
+            name=req["name"],
+            surname=req["surname"],
+            nonce=0,
+            meskenlerim=[],
+        )
+
+    @classmethod
+    def from_bson(cls, doc: dict):
+        """
+        :param doc: the user document, possibly projected
+        :return: the user
+        """
+        return _from_bson(cls, doc)
+
+    def to_bson(self) -> dict:
+        return _to_bson(self)
+
+    def to_json(self) -> dict:
+        doc = self.to_bson()
+        if "meskenlerim" in doc and isinstance(doc["meskenlerim"], list):
+            doc["meskenlerim"] = [dict(i) if isinstance(i, dict) else i for i in doc["meskenlerim"]]
+        return User.listing_json(doc)
+
+    @staticmethod
+    def listing_json(doc: dict) -> dict:
+        """
+        Encode a user fetched with PUBLIC_PROJECTION in place, without building a User
+        :param doc: the raw document from the cursor
+        :return: the same document, ready for the response
+        """
+        if "_id" in doc:
+            doc["_id"] = _str_id(doc["_id"])
+        for i in doc.get("meskenlerim") or ():
+            if isinstance(i, dict) and "meskenId" in i:
+                i["meskenId"] = _str_id(i["meskenId"])
+        return doc
+
+
+@_document
+@dataclass(slots=True)
+class Mesken:
+    # the histories are unbounded, the listing leaves them to /get_mesken
+    LISTING_PROJECTION: ClassVar[dict] = {"maintenanceHistory": 0, "saleHistory": 0}
+    VERSION_PROJECTION: ClassVar[dict] = {"version": 1}
+    REQUEST_FIELDS: ClassVar[tuple] = (
+        "meskenId", "ilId", "parselId", "zeminId", "parselNo", "mahalleId", "adaNo", "ilceId", "katNo", "kapiNo",
+        "rayicFiyat", "pay", "payda", "status", "age", "tckn"
+    )
+    KEYS: ClassVar[dict] = {}
+
+    id: Optional[ObjectId] = MISSING
+    meskenId: Optional[str] = MISSING
+    ilId: Optional[str] = MISSING
+    parselId: Optional[str] = MISSING
+    zeminId: Optional[str] = MISSING
+    parselNo: Optional[str] = MISSING
+    mahalleId: Optional[str] = MISSING
+    adaNo: Optional[str] = MISSING
+    ilceId: Optional[str] = MISSING
+    katNo: Optional[str] = MISSING
+    kapiNo: Optional[str] = MISSING
+    rayicFiyat: Optional[str] = MISSING
+    pay: Optional[str] = MISSING
+    payda: Optional[str] = MISSING
+    status: Optional[str] = MISSING
+    auctionInfo: Optional[dict] = MISSING
+    saleHistory: Optional[list] = MISSING
+    saleInfo: Optional[SaleInfo] = MISSING
+    maintenanceHistory: Optional[list] = MISSING
+    age: Optional[str] = MISSING
+    tckn: Optional[str] = MISSING
+    version: Optional[int] = 0
+    extras: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_request(cls, req: dict):
+        """
+        :param req: the /set_mesken request body
+        :return: a new mesken with empty histories
+        """
+        return cls(
+            meskenId=req["meskenId"],
+            ilId=req["ilId"],
+            parselId=req["parselId"],
+            zeminId=req["zeminId"],
+            parselNo=req["parselNo"],
+            mahalleId=req["mahalleId"],
+            adaNo=req["adaNo"],
+            ilceId=req["ilceId"],
+            katNo=req["katNo"],
+            kapiNo=req["kapiNo"],
+            rayicFiyat=req["rayicFiyat"],
+            pay=req["pay"],
+            payda=req["payda"],
+            status=req["status"],
+            auctionInfo={},
+            saleHistory=[],
+            saleInfo=None,
+            maintenanceHistory=[],
+            age=req["age"],
+            tckn=req["tckn"],
+            version=0,
+        )
+
+    @classmethod
+    def from_bson(cls, doc: dict):
+        """
+        :param doc: the mesken document, possibly projected
+        :return: the mesken
+        """
+        return _from_bson(
+            cls, doc,
+            saleInfo=lambda value: SaleInfo.from_bson(value) if isinstance(value, dict) else value,
+            maintenanceHistory=lambda value: [
+                _maintenance_entry(doc.get("_id"), i) for i in value
+            ] if isinstance(value, list) else value,
+        )
+
+    def to_bson(self) -> dict:
+        maintenance_history = self.maintenanceHistory
+        if isinstance(maintenance_history, list):
+            maintenance_history = [i.to_bson() if isinstance(i, MaintenanceEntry) else i for i in maintenance_history]
+        sale_info = self.saleInfo
+        if isinstance(sale_info, SaleInfo):
+            sale_info = sale_info.to_bson()
+        elif not sale_info:
+            # a mesken that is not on sale keeps an empty saleInfo, as it always has
+            sale_info = {}
+        return _to_bson(self, maintenanceHistory=maintenance_history, saleInfo=sale_info)
+
+    def to_json(self) -> dict:
+        return Mesken.listing_json(self.to_bson())
+
+    @staticmethod
+    def listing_json(doc: dict) -> dict:
+        """
+        Encode a mesken fetched with LISTING_PROJECTION in place, without building a Mesken.
+        The listing is the hot path, see benchmarks/bench_models.py.
+        :param doc: the raw document from the cursor
+        :return: the same document, ready for the response
+        """
+        if "_id" in doc:
+            doc["_id"] = _str_id(doc["_id"])
+        if not doc.get("saleInfo"):
+            doc["saleInfo"] = {}
+        doc.setdefault("version", 0)
+        return doc
@@ -0,0 +1,275 @@
+"""
+Snapshot export/import of the registry collections as Arrow IPC files.
+
+    python -m api.snapshot export <directory>
+    python -m api.snapshot import <directory> <database name>
+
+The scalar fields are typed columns, so Arrow, pandas or DuckDB filter and aggregate them directly: _id is the hex
+string of the ObjectId, the string fields are strings and version/nonce are int64. The nested fields (histories,
+saleInfo, ...) are extended JSON. A value whose type does not match its column, a stored null included, is left
+out of the column and kept in the _extra column with the fields outside the schema, as extended JSON, so the
+import writes back exactly what was exported.
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+from bson import json_util
+from bson.objectid import ObjectId
+from dotenv import load_dotenv, find_dotenv
+from pymongo import MongoClient, ReadPreference
+
+JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+EXTRA_FIELDS = "_extra"
+
+MESKEN_SCHEMA = pa.schema([
+    ("_id", pa.string()),
+    ("meskenId", pa.string()),
+    ("ilId", pa.string()),
+    ("ilceId", pa.string()),
+    ("mahalleId", pa.string()),
+    ("parselId", pa.string()),
+    ("zeminId", pa.string()),
+    ("parselNo", pa.string()),
+    ("adaNo", pa.string()),
+    ("katNo", pa.string()),
+    ("kapiNo", pa.string()),
+    ("rayicFiyat", pa.string()),
+    ("pay", pa.string()),
+    ("payda", pa.string()),
+    ("status", pa.string()),
+    ("age", pa.string()),
+    ("tckn", pa.string()),
+    ("version", pa.int64()),
+    ("auctionInfo", pa.string()),
+    ("saleInfo", pa.string()),
+    ("saleHistory", pa.string()),
+    ("maintenanceHistory", pa.string()),
+    (EXTRA_FIELDS, pa.string()),
+])
+
+USER_SCHEMA = pa.schema([
+    ("_id", pa.string()),
+    ("tckn", pa.string()),
+    ("password", pa.string()),
+    ("publicAddress", pa.string()),
+    ("name", pa.string()),
+    ("surname", pa.string()),
+    ("nonce", pa.int64()),
+    ("meskenlerim", pa.string()),
+    (EXTRA_FIELDS, pa.string()),
+])
+
+SCHEMAS = {
+    "meskenlerim": MESKEN_SCHEMA,
+    "users": USER_SCHEMA,
+}
+
+DATABASE_NAME = "medipoldao-digiathon"
+NESTED_FIELDS = {"auctionInfo", "saleInfo", "saleHistory", "maintenanceHistory", "meskenlerim"}
+
+CHUNK_SIZE = 10000
+
+# the column type of the fields outside the schema and the value of the fields a document does not have
+MISMATCH = object()
+
+
+def _is_plain(value) -> bool:
+    value_type = type(value)
+    if value_type is str or value is None or value_type is bool:
+        return True
+    if value_type is dict:
+        value = value.values()
+    elif value_type is not list:
+        return False
+    for i in value:
+        # the strings of the histories are checked without a call
+        if type(i) is not str and not _is_plain(i):
+            return False
+    return True
+
+
+def _dumps(value) -> str:
+    # the canonical extended JSON of strings, booleans and nulls is plain JSON, which json writes several times faster
+    return json.dumps(value) if _is_plain(value) else json_util.dumps(value, json_options=JSON_OPTIONS)
+
+
+def _loads(value: str):
+    # no "$ means no extended JSON type wrapper to decode
+    return json.loads(value) if '"$' not in value else json_util.loads(value, json_options=JSON_OPTIONS)
+
+
+def _column_types(schema: pa.Schema) -> dict:
+    """
+    :return: column name -> the Python type the column holds natively, None for the extended JSON columns
+    """
+    types = {}
+    for column in schema:
+        if column.name == EXTRA_FIELDS:
+            continue
+        if column.name == "_id":
+            types[column.name] = ObjectId
+        elif column.name in NESTED_FIELDS:
+            types[column.name] = None
+        elif column.type == pa.int64():
+            # an Int64 is stored as a BSON int64 and an int as an int32, the column would lose which one it was
+            types[column.name] = int
+        else:
+            types[column.name] = str
+    return types
+
+
+COLUMN_TYPES = {schema: _column_types(schema) for schema in SCHEMAS.values()}
+
+
+def encode_documents(schema: pa.Schema, docs: list) -> dict:
+    """
+    Encode a chunk of documents column by column, the common case of a column holding its own type stays in
+    list comprehensions
+    :param schema: the snapshot schema of the collection
+    :param docs: the documents as read from the collection
+    :return: column name -> the cells of the documents, None for the fields a document does not have or keeps
+    in _extra
+    """
+    types = COLUMN_TYPES[schema]
+    extras = [
+        {name: value for name, value in doc.items() if name not in types} if doc.keys() - types.keys() else None
+        for doc in docs
+    ]
+    columns = {}
+    for name, column_type in types.items():
+        values = [doc.get(name, MISMATCH) for doc in docs]
+        if column_type is None:
+            columns[name] = [_dumps(i) if i is not MISMATCH else None for i in values]
+            continue
+
+        cells = [i if type(i) is column_type else None for i in values]
+        if cells.count(None) != values.count(MISMATCH):
+            # stored nulls and values of another type
+            for row, value in enumerate(values):
+                if value is not MISMATCH and cells[row] is None:
+                    extras[row] = extras[row] or {}
+                    extras[row][name] = value
+        if column_type is ObjectId:
+            cells = [str(i) if i is not None else None for i in cells]
+        columns[name] = cells
+    columns[EXTRA_FIELDS] = [_dumps(i) if i else None for i in extras]
+    return columns
+
+
+def decode_documents(schema: pa.Schema, columns: dict) -> list:
+    """
+    :param schema: the snapshot schema of the collection
+    :param columns: columns written by encode_documents
+    :return: the documents
+    """
+    types = COLUMN_TYPES[schema]
+    names = [name for name in schema.names if name != EXTRA_FIELDS]
+    values = []
+    for name in names:
+        cells = columns[name]
+        if types[name] is None:
+            cells = [_loads(i) if i is not None else None for i in cells]
+        elif types[name] is ObjectId:
+            cells = [ObjectId(i) if i is not None else None for i in cells]
+        values.append(cells)
+
+    docs = []
+    # the raw cells tell a missing field from a nested field stored as null
+    for cells, row, extra in zip(zip(*(columns[name] for name in names)), zip(*values), columns[EXTRA_FIELDS]):
+        doc = {name: value for name, cell, value in zip(names, cells, row) if cell is not None}
+        if extra is not None:
+            doc.update(_loads(extra))
+        docs.append(doc)
+    return docs
+
+
+def export_collection(collection, path: str, chunk_size: int = CHUNK_SIZE) -> int:
+    """
+    Stream a collection into an Arrow IPC file, holding at most one chunk in memory
+    :param collection: meskenlerim or users
+    :param path: the file to write
+    :param chunk_size: the number of documents per record batch
+    :return: the number of exported documents
+    """
+    schema = SCHEMAS[collection.name]
+    count = 0
+
+    with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        chunk = []
+        for doc in collection.find({}, batch_size=chunk_size):
+            chunk.append(doc)
+            if len(chunk) == chunk_size:
+                writer.write_batch(pa.RecordBatch.from_pydict(encode_documents(schema, chunk), schema=schema))
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write_batch(pa.RecordBatch.from_pydict(encode_documents(schema, chunk), schema=schema))
+            count += len(chunk)
+
+    return count
+
+
+def import_collection(collection, path: str, workers: int = 4) -> int:
+    """
+    Bulk load an Arrow IPC file into a fresh collection, one record batch per insert_many
+    :param collection: the collection to load into, meskenlerim or users
+    :param path: the file written by export_collection
+    :param workers: the number of batches inserted in parallel
+    :return: the number of imported documents
+    """
+    with pa.memory_map(path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        if reader.schema != SCHEMAS[collection.name]:
+            raise ValueError("%s does not match the %s snapshot schema" % (path, collection.name))
+
+        def insert_batch(i: int) -> int:
+            docs = decode_documents(reader.schema, reader.get_batch(i).to_pydict())
+            if docs:
+                collection.insert_many(docs, ordered=False)
+            return len(docs)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(insert_batch, range(reader.num_record_batches)))
+
+
+def export_snapshot(database, directory: str):
+    """
+    :param database: the database to export, read from a secondary when there is one
+    :param directory: the directory to write one <collection>.arrow file per collection into
+    """
+    os.makedirs(directory, exist_ok=True)
+    for collection_name in SCHEMAS:
+        collection = database[collection_name].with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        start = time.perf_counter()
+        count = export_collection(collection, os.path.join(directory, collection_name + ".arrow"))
+        elapsed = time.perf_counter() - start
+        print("exported %d %s in %.2fs (%.0f docs/s)" % (count, collection_name, elapsed, count / elapsed))
+
+
+def import_snapshot(database, directory: str):
+    """
+    :param database: the fresh database to load into
+    :param directory: the directory written by export_snapshot
+    """
+    for collection_name in SCHEMAS:
+        start = time.perf_counter()
+        count = import_collection(database[collection_name], os.path.join(directory, collection_name + ".arrow"))
+        elapsed = time.perf_counter() - start
+        print("imported %d %s in %.2fs (%.0f docs/s)" % (count, collection_name, elapsed, count / elapsed))
+
+
+if __name__ == "__main__":
+    # a plain client: the CLI must not start the audit writer or create indexes like the API does
+    load_dotenv(find_dotenv())
+    client = MongoClient(os.environ.get("MONGODB_PWD"))
+    if len(sys.argv) == 3 and sys.argv[1] == "export":
+        export_snapshot(client[DATABASE_NAME], sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == "import":
+        import_snapshot(client[sys.argv[3]], sys.argv[2])
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,57 @@
+"""
+Bytes on the wire and latency of /get_meskens: identity, gzip and a 304 revalidation.
+
+    python -m benchmarks.bench_etag_gzip [number of meskens]
+
+The database is replaced by an in-memory listing, so the figures are the API side only; a 304 also saves the
+listing query against MongoDB, which is not included here.
+"""
+import sys
+import time
+from contextlib import nullcontext
+
+from benchmarks.fixtures import make_mesken
+from fastapi.testclient import TestClient
+
+from api import main
+from api.models import Mesken
+
+REQUESTS = 200
+
+
+def measure(client: TestClient, headers: dict):
+    response = client.get("/get_meskens", headers=headers)
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        response = client.get("/get_meskens", headers=headers)
+    elapsed = (time.perf_counter() - start) / REQUESTS
+    return response, elapsed
+
+
+def main_(count: int):
+    docs = [make_mesken(i) for i in range(count)]
+    for doc in docs:
+        for name in Mesken.LISTING_PROJECTION:
+            del doc[name]
+    listing = {i: Mesken.from_bson(doc).to_json() for i, doc in enumerate(docs)}
+    etag = 'W/"meskens-%d"' % sum(doc["version"] for doc in docs)
+
+    main.db.causal_session = lambda token=None: nullcontext()
+    main.db.get_meskens_etag = lambda session=None: etag
+    main.db.get_meskens = lambda session=None: listing
+    client = TestClient(main.app)
+
+    cases = [
+        ("identity", {"Accept-Encoding": "identity"}),
+        ("gzip", {"Accept-Encoding": "gzip"}),
+        ("304", {"Accept-Encoding": "gzip", "If-None-Match": etag}),
+    ]
+    print("%d meskens, mean of %d requests" % (count, REQUESTS))
+    for name, headers in cases:
+        response, elapsed = measure(client, headers)
+        print("%-8s status %d  %9d bytes  %7.2f ms" % (
+            name, response.status_code, response.num_bytes_downloaded, elapsed * 1000))
+
+
+if __name__ == "__main__":
+    main_(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
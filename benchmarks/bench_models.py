@@ -0,0 +1,75 @@
+"""
+Memory per document and encode throughput of the raw dict path, the Mesken model path and the listing fast path.
+
+    python -m benchmarks.bench_models [number of meskens]
+
+Every path starts from the BSON bytes the driver receives and ends with the response body, so the figures include
+decoding, the model conversion and the response encoding. The dict and model paths go through the jsonable_encoder
+pass FastAPI runs on returned values, the listing routes return their JSONResponse directly.
+"""
+import sys
+import time
+import tracemalloc
+
+import bson
+from benchmarks.fixtures import make_mesken
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import api.db_wrapper  # noqa: F401, registers the ObjectId encoder the dict path relies on
+from api.models import Mesken
+
+
+def memory_per_document(raw: list, decode) -> float:
+    tracemalloc.start()
+    docs = [decode(i) for i in raw]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return size / len(raw)
+
+
+def throughput(raw: list, encode, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(raw)
+        best = min(best, time.perf_counter() - start)
+    return len(raw) / best
+
+
+def main_(count: int):
+    full = [bson.encode(make_mesken(i)) for i in range(count)]
+    listing = []
+    for i in range(count):
+        doc = make_mesken(i)
+        for name in Mesken.LISTING_PROJECTION:
+            del doc[name]
+        listing.append(bson.encode(doc))
+
+    print("%d meskens" % count)
+    print("memory per full document: dict %.0f B, Mesken %.0f B" % (
+        memory_per_document(full, bson.decode),
+        memory_per_document(full, lambda i: Mesken.from_bson(bson.decode(i))),
+    ))
+
+    paths = [
+        ("dict", lambda raw: JSONResponse(jsonable_encoder(
+            {i: bson.decode(doc) for i, doc in enumerate(raw)}
+        )).body),
+        ("Mesken.to_json", lambda raw: JSONResponse(jsonable_encoder(
+            {i: Mesken.from_bson(bson.decode(doc)).to_json() for i, doc in enumerate(raw)}
+        )).body),
+        ("listing_json", lambda raw: JSONResponse(
+            {i: Mesken.listing_json(bson.decode(doc)) for i, doc in enumerate(raw)}
+        ).body),
+    ]
+    for name, docs in (("full", full), ("listing", listing)):
+        for path, encode in paths:
+            if name == "full" and path == "listing_json":
+                continue
+            print("%-7s %-15s %8.0f docs/s" % (name, path, throughput(docs, encode)))
+
+
+if __name__ == "__main__":
+    main_(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,89 @@
+"""
+Primary offload of the per-method read routing, on a simulated replica set of one primary and two secondaries.
+
+    python -m benchmarks.bench_read_routing [number of requests]
+
+The workload replays the DbWrapper calls of a request mix (listings, owner reads of a mesken, sales and the admin
+user listing) once with every read on the primary and once with DbWrapper.READ_PREFERENCES, and counts the
+operations each member serves. secondaryPreferred reads are spread round-robin over the secondaries.
+"""
+import os
+import random
+import sys
+from collections import Counter
+
+import jwt
+from benchmarks.fixtures import make_mesken
+from pymongo import ReadPreference
+
+from api import db_wrapper
+from api.db_wrapper import DbWrapper
+from api.models import SaleInfo
+from tests.fakes import FakeClient
+
+SECONDARIES = 2
+MIX = [
+    ("listing", 0.60),
+    ("owner read", 0.25),
+    ("put on sale", 0.10),
+    ("user listing", 0.05),
+]
+
+
+class SimulatedTopology(FakeClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.served = Counter()
+
+    def members(self):
+        next_secondary = 0
+        for kind, name, read_preference, session in self.operations:
+            if kind == "read" and read_preference != ReadPreference.PRIMARY:
+                self.served["secondary %d" % (next_secondary % SECONDARIES + 1)] += 1
+                next_secondary += 1
+            else:
+                self.served["primary"] += 1
+        return self.served
+
+
+def run(db: DbWrapper, requests: int):
+    rng = random.Random(0)
+    mesken_id = str(db.client.docs["meskenlerim"][0]["_id"])
+    token = jwt.encode({"tckn": "1"}, os.environ["SECRET"], algorithm="HS256")
+    kinds, weights = zip(*MIX)
+
+    for kind in rng.choices(kinds, weights, k=requests):
+        if kind == "listing":
+            with db.causal_session() as session:
+                db.get_meskens_etag(session)
+                db.get_meskens(session)
+        elif kind == "owner read":
+            with db.causal_session(token) as session:
+                db.get_mesken_etag(mesken_id, session)
+                db.get_mesken(mesken_id, session)
+        elif kind == "put on sale":
+            db.put_on_sale(token, SaleInfo(mesken_id, "10", "1"))
+        else:
+            db.get_users()
+    return db.client.members()
+
+
+def main_(requests: int):
+    db_wrapper.MongoClient = SimulatedTopology
+    print("%d requests: %s" % (requests, ", ".join("%d%% %s" % (weight * 100, kind) for kind, weight in MIX)))
+
+    for name, read_preferences in (("all on primary", {}), ("READ_PREFERENCES", DbWrapper.READ_PREFERENCES)):
+        DbWrapper.READ_PREFERENCES = read_preferences
+        db = DbWrapper()
+        db.client.docs["users"] = [{"tckn": "1"}]
+        db.client.docs["meskenlerim"] = [make_mesken(0)]
+        served = run(db, requests)
+        total = sum(served.values())
+        print("%-17s primary %6d (%3.0f%%)  %s" % (
+            name, served["primary"], 100 * served["primary"] / total,
+            "  ".join("%s %6d" % (member, served[member]) for member in sorted(served) if member != "primary"),
+        ))
+
+
+if __name__ == "__main__":
+    main_(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,73 @@
+"""
+Export and import throughput of the Arrow snapshot, against an extended JSON dump of the same collection.
+
+    python -m benchmarks.bench_snapshot [number of meskens]
+
+The collections are in-memory fakes, so the figures are the encoding, the file and the decoding only; against
+MongoDB the cursor and insert_many round trips come on top.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.fixtures import make_mesken
+from bson import json_util
+
+from api import snapshot
+from tests.fakes import FakeClient
+
+
+def timed(func, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def import_into(client: FakeClient, load):
+    # every run starts from an empty collection
+    client.docs.clear()
+    load()
+
+
+def main_(count: int):
+    source, target = FakeClient(), FakeClient()
+    source.docs["meskenlerim"] = [make_mesken(i) for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "meskenlerim.arrow")
+        export_time = timed(lambda: snapshot.export_collection(source["db"]["meskenlerim"], path))
+        import_time = timed(lambda: import_into(target, lambda: snapshot.import_collection(
+            target["db"]["meskenlerim"], path)))
+        arrow_size = os.path.getsize(path)
+
+        json_path = os.path.join(directory, "meskenlerim.json")
+
+        def dump():
+            with open(json_path, "w") as f:
+                for doc in source["db"]["meskenlerim"].find({}):
+                    f.write(json_util.dumps(doc, json_options=snapshot.JSON_OPTIONS) + "\n")
+
+        def load():
+            with open(json_path) as f:
+                target["db"]["meskenlerim"].insert_many(
+                    [json_util.loads(line, json_options=snapshot.JSON_OPTIONS) for line in f]
+                )
+
+        dump_time = timed(dump)
+        load_time = timed(lambda: import_into(target, load))
+        json_size = os.path.getsize(json_path)
+
+    assert len(target.docs["meskenlerim"]) == count
+    print("%d meskens, best of 3" % count)
+    print("%-6s export %8.0f docs/s  import %8.0f docs/s  %6.1f MB" % (
+        "arrow", count / export_time, count / import_time, arrow_size / 1e6))
+    print("%-6s export %8.0f docs/s  import %8.0f docs/s  %6.1f MB" % (
+        "json", count / dump_time, count / load_time, json_size / 1e6))
+
+
+if __name__ == "__main__":
+    main_(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,44 @@
+import os
+import random
+
+from bson.objectid import ObjectId
+
+# the benchmarks never reach the database, pymongo only needs a well-formed connection string
+os.environ.setdefault("MONGODB_PWD", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("SECRET", "benchmark-secret-of-at-least-thirty-two-bytes")
+
+
+def make_mesken(i: int, maintenance: int = 5) -> dict:
+    """
+    :param i: the index of the mesken, seeds its values
+    :param maintenance: the number of maintenance entries
+    :return: a mesken document as the API stores it
+    """
+    rng = random.Random(i)
+    return {
+        "_id": ObjectId(),
+        "meskenId": str(i),
+        "ilId": str(rng.randint(1, 81)),
+        "parselId": str(rng.randint(1, 10 ** 6)),
+        "zeminId": str(rng.randint(1, 10 ** 6)),
+        "parselNo": str(rng.randint(1, 500)),
+        "mahalleId": str(rng.randint(1, 10 ** 5)),
+        "adaNo": str(rng.randint(1, 2000)),
+        "ilceId": str(rng.randint(1, 973)),
+        "katNo": str(rng.randint(0, 20)),
+        "kapiNo": str(rng.randint(1, 200)),
+        "rayicFiyat": str(rng.randint(10 ** 5, 10 ** 7)),
+        "pay": str(rng.randint(1, 100)),
+        "payda": "100",
+        "status": str(rng.randint(0, 2)),
+        "auctionInfo": {},
+        "saleHistory": [],
+        "saleInfo": {},
+        "maintenanceHistory": [
+            {"date": "2022-10-%02d" % (j + 1), "desc": "bakim %d" % j, "price": str(rng.randint(100, 10000))}
+            for j in range(maintenance)
+        ],
+        "age": str(rng.randint(0, 80)),
+        "tckn": str(rng.randint(10 ** 10, 10 ** 11 - 1)),
+        "version": rng.randint(0, 10),
+    }
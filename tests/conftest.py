@@ -0,0 +1,5 @@
+import os
+
+# pymongo connects lazily, so importing the app only needs a well-formed connection string
+os.environ.setdefault("MONGODB_PWD", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+os.environ.setdefault("SECRET", "test-secret-of-at-least-thirty-two-bytes")
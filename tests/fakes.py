@@ -0,0 +1,120 @@
+"""
+In-memory stand-in for the parts of a replica set client DbWrapper uses: every read is logged with the read
+preference it was routed with, and every operation in a session advances the session's operation time.
+"""
+from types import SimpleNamespace
+
+from bson.timestamp import Timestamp
+from pymongo import ReadPreference
+
+
+class FakeSession:
+    def __init__(self):
+        self.cluster_time = None
+        self.operation_time = None
+        self.advanced_to = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def advance_cluster_time(self, cluster_time):
+        self.cluster_time = cluster_time
+
+    def advance_operation_time(self, operation_time):
+        self.advanced_to = operation_time
+        self.operation_time = operation_time
+
+
+class FakeCursor(list):
+    def sort(self, *args, **kwargs):
+        return self
+
+
+class FakeCollection:
+    def __init__(self, client, name, read_preference=ReadPreference.PRIMARY):
+        self.client = client
+        self.name = name
+        self.read_preference = read_preference
+
+    def with_options(self, read_preference=None, **kwargs):
+        return FakeCollection(self.client, self.name, read_preference or self.read_preference)
+
+    def _operation(self, kind, session):
+        self.client.operations.append((kind, self.name, self.read_preference, session))
+        if session is not None:
+            self.client.clock += 1
+            session.cluster_time = {"clusterTime": Timestamp(self.client.clock, 0)}
+            session.operation_time = Timestamp(self.client.clock, 0)
+
+    def find(self, filter=None, projection=None, session=None, **kwargs):
+        self._operation("read", session)
+        return FakeCursor(dict(i) for i in self.client.docs.get(self.name, []))
+
+    def _matching(self, filter):
+        # equality on the top level fields only, operator conditions match every document
+        return [i for i in self.client.docs.get(self.name, [])
+                if all(i.get(key) == value for key, value in (filter or {}).items() if not isinstance(value, dict))]
+
+    def find_one(self, filter=None, projection=None, session=None, **kwargs):
+        self._operation("read", session)
+        docs = self._matching(filter)
+        return dict(docs[0]) if docs else None
+
+    def aggregate(self, pipeline, session=None, **kwargs):
+        self._operation("read", session)
+        docs = self.client.docs.get(self.name, [])
+        return iter([{"_id": None, "count": len(docs), "version": sum(i.get("version", 0) for i in docs)}])
+
+    def update_one(self, filter, update, session=None, upsert=False, **kwargs):
+        self._operation("write", session)
+        if upsert:
+            docs = self._matching(filter)
+            if not docs:
+                docs = [{"_id": filter["_id"]}]
+                self.client.docs.setdefault(self.name, []).extend(docs)
+            docs[0].update(update.get("$set", {}))
+        return SimpleNamespace(matched_count=1)
+
+    def insert_one(self, doc, session=None, **kwargs):
+        self._operation("write", session)
+        return SimpleNamespace(inserted_id=doc.setdefault("_id", self.client.clock))
+
+    def insert_many(self, docs, **kwargs):
+        self.client.docs.setdefault(self.name, []).extend(docs)
+        return SimpleNamespace(inserted_ids=[i.get("_id") for i in docs])
+
+    def bulk_write(self, requests, session=None, **kwargs):
+        self._operation("write", session)
+        return SimpleNamespace(matched_count=len(requests))
+
+    def create_index(self, keys, **kwargs):
+        return "index"
+
+
+class FakeDatabase:
+    def __init__(self, client):
+        self.client = client
+
+    def __getitem__(self, name):
+        return FakeCollection(self.client, name)
+
+
+class FakeClient:
+    def __init__(self, *args, **kwargs):
+        self.operations = []
+        self.sessions = []
+        self.docs = {}
+        self.clock = 0
+
+    def __getitem__(self, name):
+        return FakeDatabase(self)
+
+    def start_session(self, causal_consistency=True):
+        self.sessions.append(FakeSession())
+        return self.sessions[-1]
+
+    def reads(self):
+        return [(name, read_preference) for kind, name, read_preference, _ in self.operations if kind == "read"]
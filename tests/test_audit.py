@@ -0,0 +1,251 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import BulkWriteError, ServerSelectionTimeoutError
+
+from api.audit import AuditLog, apply_update
+from api.errors import IncompleteHistory
+
+T0 = datetime(2022, 10, 1, tzinfo=timezone.utc)
+
+
+def matches(doc: dict, query: dict) -> bool:
+    # the subset of the query language AuditLog uses
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(doc, i) for i in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, i) for i in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = doc.get(key)
+            if "$lt" in condition and not value < condition["$lt"]:
+                return False
+            if "$lte" in condition and not value <= condition["$lte"]:
+                return False
+            if "$gt" in condition and not value > condition["$gt"]:
+                return False
+            if "$gte" in condition and not value >= condition["$gte"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+class Cursor(list):
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            super().sort(key=lambda i: i[key], reverse=direction < 0)
+        return self
+
+
+class MemoryCollection:
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+
+    def find(self, query, projection=None):
+        return Cursor(dict(i) for i in self.docs if matches(i, query))
+
+    def find_one(self, query, projection=None, sort=None):
+        docs = self.find(query).sort(sort) if sort else self.find(query)
+        return docs[0] if docs else None
+
+    def replace_one(self, query, doc, upsert=False):
+        self.docs = [i for i in self.docs if not matches(i, query)] + [doc]
+
+    def update_one(self, query, update, upsert=False):
+        docs = [i for i in self.docs if matches(i, query)]
+        if not docs and upsert:
+            docs = [dict(query)]
+            self.docs.append(docs[0])
+        for doc in docs[:1]:
+            apply_update(doc, update)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def create_index(self, keys):
+        return "index"
+
+
+def event(minutes: int, update: dict, created: bool = False, entity: str = "mesken:1") -> dict:
+    ts = T0 + timedelta(minutes=minutes)
+    return {"entity": entity, "ts": ts, "seq": minutes, "created": created, "update": update}
+
+
+def audit_log(events=(), snapshots=(), entities=(), **kwargs) -> AuditLog:
+    return AuditLog(MemoryCollection(events), MemoryCollection(snapshots), MemoryCollection(entities), **kwargs)
+
+
+def test_apply_update_supports_set_push_and_inc():
+    state = apply_update({"status": "1", "version": 1}, {
+        "$set": {"status": "2"},
+        "$push": {"maintenanceHistory": {"desc": "boya"}},
+        "$inc": {"version": 1},
+    })
+    assert state == {"status": "2", "version": 2, "maintenanceHistory": [{"desc": "boya"}]}
+    assert apply_update(state, {"$push": {"maintenanceHistory": {"desc": "cati"}}})["maintenanceHistory"] == [
+        {"desc": "boya"}, {"desc": "cati"}
+    ]
+
+
+def test_replay_starts_from_the_latest_snapshot_before_ts():
+    log = audit_log(
+        events=[
+            event(0, {"$set": {"status": "0", "version": 0}}, created=True),
+            event(1, {"$inc": {"version": 1}}),
+            event(2, {"$inc": {"version": 1}}),
+            event(3, {"$set": {"status": "3"}}),
+        ],
+        # deliberately not what the events before it add up to, to show they are skipped
+        snapshots=[
+            {"entity": "mesken:1", "ts": T0 + timedelta(minutes=2), "seq": 2, "epoch": 0,
+             "state": {"status": "s", "version": 9}},
+            {"entity": "mesken:2", "ts": T0 + timedelta(minutes=3), "seq": 3, "epoch": 0, "state": {"status": "other"}},
+        ],
+    )
+
+    assert log.replay("mesken:1", T0 + timedelta(minutes=3)) == {"status": "3", "version": 9}
+    assert log.replay("mesken:1", T0 + timedelta(minutes=1)) == {"status": "0", "version": 1}
+    assert log.replay("mesken:1", T0 - timedelta(minutes=1)) is None
+
+
+def test_replay_orders_events_of_the_same_millisecond_by_seq():
+    first, second = event(1, {"$set": {"status": "a"}}), event(1, {"$set": {"status": "b"}})
+    first["seq"], second["seq"] = 10, 11
+    log = audit_log(events=[second, event(0, {"$set": {}}, created=True), first])
+
+    assert log.replay("mesken:1", T0 + timedelta(minutes=1)) == {"status": "b"}
+
+
+def test_replay_stores_a_snapshot_after_too_many_deltas():
+    log = audit_log(events=[event(0, {"$set": {"version": 0}}, created=True)] + [
+        event(i, {"$inc": {"version": 1}}) for i in range(1, 5)
+    ])
+    log.SNAPSHOT_INTERVAL = 3
+
+    assert log.replay("mesken:1", T0 + timedelta(minutes=10)) == {"version": 4}
+    assert [(i["seq"], i["state"]) for i in log.snapshots.docs] == [(4, {"version": 4})]
+
+    # the second replay starts from the snapshot and does not store it again
+    assert log.replay("mesken:1", T0 + timedelta(minutes=10)) == {"version": 4}
+    assert len(log.snapshots.docs) == 1
+
+
+def test_replay_does_not_snapshot_events_within_the_horizon():
+    now = time.time_ns()
+    events = [event(0, {"$set": {"version": 0}}, created=True)] + [
+        event(i, {"$inc": {"version": 1}}) for i in range(1, 5)
+    ]
+    # the last two events are recent, events of other workers may still be on their way before them
+    for i in events[3:]:
+        i["seq"], i["ts"] = now, datetime.now(timezone.utc)
+    log = audit_log(events=events)
+    log.SNAPSHOT_INTERVAL = 2
+
+    assert log.replay("mesken:1", datetime.now(timezone.utc) + timedelta(minutes=1)) == {"version": 4}
+    assert [(i["seq"], i["state"]) for i in log.snapshots.docs] == [(2, {"version": 2})]
+
+
+def test_writer_snapshots_every_interval_events():
+    log = audit_log()
+    log.SNAPSHOT_INTERVAL = 3
+    # the writer only snapshots events older than the horizon, with none every batch is late and bumps the epoch
+    log.horizon_ns = 0
+    log.record("mesken:1", "set_mesken", {"$set": {"version": 0}}, created=True)
+    for _ in range(4):
+        log.record("mesken:1", "add_maintenance", {"$inc": {"version": 1}})
+    log.close()
+
+    assert [i["state"] for i in log.snapshots.docs] == [{"version": 4}]
+    assert log.entities.docs[0]["sinceSnapshot"] == 0
+    assert log.snapshots.docs[0]["epoch"] == log.epoch("mesken:1")
+
+
+def test_late_event_discards_the_snapshots_of_its_entity():
+    log = audit_log(
+        events=[event(0, {"$set": {"version": 0}}, created=True), event(2, {"$inc": {"version": 1}})],
+        # taken while the event at minute 1 was still queued
+        snapshots=[{"entity": "mesken:1", "ts": T0 + timedelta(minutes=2), "seq": 2, "epoch": 0,
+                    "state": {"version": 1}}],
+        horizon=60,
+    )
+    log.write([event(1, {"$inc": {"version": 1}})])
+
+    assert log.entities.docs == [{"_id": "mesken:1", "sinceSnapshot": 1, "epoch": 1}]
+    assert log.replay("mesken:1", T0 + timedelta(minutes=2)) == {"version": 2}
+
+
+def test_replay_without_a_creation_event_is_incomplete():
+    log = audit_log(events=[event(1, {"$inc": {"version": 1}})])
+
+    with pytest.raises(IncompleteHistory):
+        log.replay("mesken:1", T0 + timedelta(minutes=1))
+
+
+def test_write_tolerates_duplicates_of_a_retried_batch():
+    class PartlyWritten(MemoryCollection):
+        def __init__(self, code):
+            super().__init__()
+            self.code = code
+
+        def insert_many(self, docs, ordered=True):
+            raise BulkWriteError({"writeErrors": [{"code": self.code}]})
+
+    log = AuditLog(PartlyWritten(11000), MemoryCollection(), MemoryCollection())
+    log.write([event(0, {"$set": {}}, created=True)])
+    with pytest.raises(BulkWriteError):
+        AuditLog(PartlyWritten(121), MemoryCollection(), MemoryCollection()).write([event(0, {"$set": {}})])
+
+
+def test_failed_batch_is_kept_and_written_again():
+    failed = threading.Event()
+
+    class Unavailable(MemoryCollection):
+        def insert_many(self, docs, ordered=True):
+            if not failed.is_set():
+                failed.set()
+                raise ServerSelectionTimeoutError("no primary")
+            super().insert_many(docs, ordered)
+
+    log = AuditLog(Unavailable(), MemoryCollection(), MemoryCollection(), flush_interval=0.01)
+    for i in range(3):
+        log.record("mesken:1", "add_maintenance", {"$inc": {"version": 1}})
+    assert failed.wait(5)
+    log.close()
+
+    assert len(log.events.docs) == 3
+
+
+def test_full_queue_drops_events(caplog):
+    release = threading.Event()
+
+    class Blocked(MemoryCollection):
+        def create_index(self, keys):
+            release.wait(5)
+
+    log = AuditLog(Blocked(), MemoryCollection(), MemoryCollection(), max_queued=1)
+    with caplog.at_level(logging.ERROR, logger="api.audit"):
+        log.record("mesken:1", "add_maintenance", {"$inc": {"version": 1}})
+        log.record("mesken:1", "add_maintenance", {"$inc": {"version": 1}})
+    release.set()
+    log.close()
+
+    assert "dropping add_maintenance of mesken:1" in caplog.text
+    assert len(log.events.docs) == 1
+
+
+def test_close_without_events_does_not_start_the_writer():
+    log = audit_log()
+    log.close()
+    assert log.writer is None
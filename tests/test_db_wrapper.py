@@ -0,0 +1,172 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pytest
+from bson.objectid import ObjectId
+from fastapi.testclient import TestClient
+from pymongo import ReadPreference
+
+from api import db_wrapper, main
+from api.db_wrapper import DbWrapper
+from api.errors import IncompleteHistory, MeskenNotFound
+from api.models import MaintenanceEntry, Mesken, SaleInfo
+from fakes import FakeClient
+
+MESKEN_ID = str(ObjectId())
+
+
+def mesken_request() -> dict:
+    return {name: "1" for name in Mesken.REQUEST_FIELDS}
+
+
+def token_for(tckn: str) -> str:
+    return jwt.encode({"tckn": tckn}, os.environ["SECRET"], algorithm="HS256")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(db_wrapper, "MongoClient", FakeClient)
+    db = DbWrapper()
+    db.client.docs["users"] = [{"_id": ObjectId(), "tckn": "1"}]
+    db.client.docs["meskenlerim"] = [{"_id": ObjectId(MESKEN_ID), "version": 2}]
+    db.client.docs["counters"] = [{"_id": "meskenlerim", "version": 5}]
+    return db
+
+
+@pytest.mark.parametrize("method, args", [
+    ("get_meskens", ()),
+    ("get_meskens_etag", ()),
+    ("get_users", ()),
+    ("get_mesken", (MESKEN_ID,)),
+    ("get_mesken_etag", (MESKEN_ID,)),
+])
+def test_listing_and_mesken_reads_go_to_secondaries(db, method, args):
+    getattr(db, method)(*args)
+    reads = db.client.reads()
+    assert reads and all(read_preference == ReadPreference.SECONDARY_PREFERRED for _, read_preference in reads)
+
+
+@pytest.mark.parametrize("method", ["user_exists", "user_exists_by_tckn"])
+def test_existence_checks_stay_on_the_primary(db, method):
+    getattr(db, method)("1")
+    assert db.client.reads() == [("users", ReadPreference.PRIMARY)]
+
+
+def test_reads_resume_after_the_users_last_write(db):
+    db.add_maintenance(MESKEN_ID, MaintenanceEntry("2022-10-01", "boya", "100"), token_for("1"))
+    written = db.client.sessions[-1].operation_time
+
+    with db.causal_session(token_for("1")) as session:
+        assert session.advanced_to == written
+
+    with db.causal_session(token_for("2")) as session:
+        assert session.advanced_to is None
+
+    with db.causal_session() as session:
+        assert session.advanced_to is None
+
+
+def test_reads_do_not_store_causal_times(db):
+    with db.causal_session(token_for("1")) as session:
+        db.get_mesken(MESKEN_ID, session)
+    assert "causalTimes" not in db.client.docs
+
+
+def test_causal_times_are_shared_between_workers(monkeypatch):
+    client = FakeClient()
+    client.docs["users"] = [{"_id": ObjectId(), "tckn": "1"}]
+    client.docs["meskenlerim"] = [{"_id": ObjectId(MESKEN_ID), "version": 2}]
+    monkeypatch.setattr(db_wrapper, "MongoClient", lambda *args, **kwargs: client)
+    writer, reader = DbWrapper(), DbWrapper()
+
+    writer.put_on_sale(token_for("1"), SaleInfo(MESKEN_ID, "10", "1"))
+    written = client.sessions[-1].operation_time
+    with reader.causal_session(token_for("1")) as session:
+        assert session.advanced_to == written
+
+
+@pytest.mark.parametrize("write", [
+    lambda db, token: db.add_maintenance(MESKEN_ID, MaintenanceEntry("2022-10-01", "boya", "100"), token),
+    lambda db, token: db.update_mesken(token, MESKEN_ID, "7", MaintenanceEntry("2022-10-01", "boya", "100")),
+    lambda db, token: db.put_on_sale(token, SaleInfo(MESKEN_ID, "10", "1")),
+])
+def test_version_bumping_writes_run_in_the_owners_session(db, write):
+    write(db, token_for("1"))
+    writes = [operation for operation in db.client.operations if operation[0] == "write"]
+    assert writes and all(session is not None for kind, name, _, session in writes if name != "causalTimes")
+    assert db.get_causal_times("1")["operationTime"] == db.client.sessions[-1].operation_time
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setattr(main, "db", db)
+    return TestClient(main.app, raise_server_exceptions=False)
+
+
+def test_reads_resume_the_session_of_the_bearer(client, db):
+    db.client.docs["causalTimes"] = [{"_id": "1", "clusterTime": None, "operationTime": "after the write"}]
+    response = client.get("/get_mesken", params={"meskenId": MESKEN_ID},
+                          headers={"Authorization": "Bearer " + token_for("1")})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == 'W/"%s-2"' % MESKEN_ID
+    assert db.client.sessions[-1].advanced_to == "after the write"
+
+
+def test_invalid_bearer_falls_back_to_an_anonymous_session(client, db):
+    response = client.get("/get_meskens", headers={"Authorization": "Bearer expired"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == 'W/"meskens-5"'
+    assert db.client.sessions[-1].advanced_to is None
+
+
+def test_get_mesken_revalidates_with_304(client):
+    etag = 'W/"%s-2"' % MESKEN_ID
+    response = client.get("/get_mesken", params={"meskenId": MESKEN_ID}, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_post_get_mesken_is_never_conditional(client):
+    response = client.post("/get_mesken", json={"meskenId": MESKEN_ID},
+                           headers={"If-None-Match": 'W/"%s-2"' % MESKEN_ID})
+    assert response.status_code == 200
+    assert response.json()["_id"] == MESKEN_ID
+
+
+def test_get_mesken_requires_the_id(client):
+    response = client.get("/get_mesken")
+    assert response.status_code == 400
+    assert response.json() == {"message": "Missing field: meskenId"}
+
+
+@pytest.mark.parametrize("write", [
+    lambda db, token: db.set_mesken(Mesken.from_request(mesken_request()), token),
+    lambda db, token: db.add_maintenance(MESKEN_ID, MaintenanceEntry("2022-10-01", "boya", "100"), token),
+    lambda db, token: db.update_mesken(token, MESKEN_ID, "7", MaintenanceEntry("2022-10-01", "boya", "100")),
+    lambda db, token: db.put_on_sale(token, SaleInfo(MESKEN_ID, "10", "1")),
+])
+def test_mesken_writes_bump_the_listing_counter(db, write):
+    write(db, token_for("1"))
+    assert "counters" in [name for kind, name, _, session in db.client.operations if kind == "write" and session]
+
+
+def test_listing_etag_reads_one_counter_document(db):
+    assert db.get_meskens_etag() == 'W/"meskens-5"'
+    assert db.client.reads() == [("counters", ReadPreference.SECONDARY_PREFERRED)]
+
+
+def test_token_in_query_string_is_ignored(client, db):
+    client.get("/get_meskens", params={"token": token_for("1")})
+    assert db.client.sessions[-1].advanced_to is None
+
+
+def test_mesken_older_than_the_audit_log_has_no_past_state(db, monkeypatch):
+    monkeypatch.setattr(db.audit, "replay", lambda entity, ts: None)
+    created = datetime(2022, 10, 1, tzinfo=timezone.utc)
+    mesken_id = str(ObjectId.from_datetime(created))
+
+    with pytest.raises(IncompleteHistory):
+        db.get_mesken_at(mesken_id, created + timedelta(days=1))
+    with pytest.raises(MeskenNotFound):
+        db.get_mesken_at(mesken_id, created - timedelta(days=1))
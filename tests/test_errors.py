@@ -0,0 +1,62 @@
+import pytest
+from pymongo.errors import AutoReconnect, ServerSelectionTimeoutError
+
+from api import errors
+from api.errors import DatabaseUnavailable, retry_transient
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    delays = []
+    monkeypatch.setattr(errors.time, "sleep", delays.append)
+    return delays
+
+
+def test_retry_transient_retries_auto_reconnect(no_sleep):
+    calls = []
+
+    @retry_transient(retries=3, base_delay=0.1)
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise AutoReconnect("primary stepped down")
+        return "ok"
+
+    assert flaky() == "ok"
+    assert len(calls) == 3
+    assert len(no_sleep) == 2
+    assert 0 <= no_sleep[0] <= 0.1 and 0 <= no_sleep[1] <= 0.2
+
+
+def test_retry_transient_gives_up_with_database_unavailable(no_sleep):
+    @retry_transient(retries=2)
+    def down():
+        raise AutoReconnect("no primary")
+
+    with pytest.raises(DatabaseUnavailable):
+        down()
+    assert len(no_sleep) == 2
+
+
+def test_retry_transient_does_not_retry_server_selection_timeout(no_sleep):
+    calls = []
+
+    @retry_transient()
+    def unreachable():
+        calls.append(1)
+        raise ServerSelectionTimeoutError("no servers")
+
+    with pytest.raises(DatabaseUnavailable):
+        unreachable()
+    assert calls == [1]
+    assert no_sleep == []
+
+
+def test_retry_transient_does_not_retry_other_errors(no_sleep):
+    @retry_transient()
+    def broken():
+        raise ValueError("bug")
+
+    with pytest.raises(ValueError):
+        broken()
+    assert no_sleep == []
@@ -0,0 +1,90 @@
+import os
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+from api import main
+from api.errors import BadRequest, UserNotFound, error_counts
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app, raise_server_exceptions=False)
+
+
+def test_require_accepts_present_fields():
+    main.require({"tckn": "1", "password": ""}, "tckn", "password")
+
+
+def test_require_lists_missing_fields():
+    with pytest.raises(BadRequest) as error:
+        main.require({"tckn": "1"}, "tckn", "password", "name")
+    assert error.value.message == "Missing field: password, name"
+
+
+def test_missing_field_is_a_bad_request(client):
+    response = client.post("/login", json={"tckn": "1"})
+    assert response.status_code == 400
+    assert response.json() == {"message": "Missing field: password"}
+
+
+def test_api_errors_keep_their_status_and_are_counted(client, monkeypatch):
+    def login(tckn, password):
+        raise UserNotFound()
+
+    monkeypatch.setattr(main.db, "login", login)
+    before = error_counts["UserNotFound"]
+    response = client.post("/login", json={"tckn": "1", "password": "x"})
+    assert response.status_code == 404
+    assert response.json() == {"message": "User not found"}
+    assert error_counts["UserNotFound"] == before + 1
+
+
+def test_internal_key_error_is_a_server_error(client, monkeypatch):
+    def login(tckn, password):
+        return {}["password"]
+
+    monkeypatch.setattr(main.db, "login", login)
+    response = client.post("/login", json={"tckn": "1", "password": "x"})
+    assert response.status_code == 500
+
+
+def test_non_object_body_is_a_bad_request(client):
+    response = client.post("/login", content="not json", headers={"content-type": "application/json"})
+    assert response.status_code == 400
+
+
+def test_verify_returns_the_payload_itself(client):
+    token = jwt.encode({"tckn": "1"}, os.environ["SECRET"], algorithm="HS256")
+    response = client.post("/verify", json={"token": token})
+    assert response.status_code == 200
+    assert response.json() == {"message": "User verified", "user": {"tckn": "1"}}
+
+
+def test_invalid_token_is_unauthorized(client):
+    response = client.post("/verify", json={"token": "garbage"})
+    assert response.status_code == 401
+
+
+def request_with(if_none_match: str = None):
+    headers = [] if if_none_match is None else [(b"if-none-match", if_none_match.encode())]
+    return main.Request({"type": "http", "headers": headers})
+
+
+def test_etag_matches_weak_and_strong_client_tags():
+    assert main.etag_matches(request_with('W/"abc-1"'), 'W/"abc-1"')
+    assert main.etag_matches(request_with('"abc-1"'), 'W/"abc-1"')
+    assert main.etag_matches(request_with('"x", W/"abc-1"'), 'W/"abc-1"')
+    assert main.etag_matches(request_with("*"), 'W/"abc-1"')
+
+
+def test_etag_matches_rejects_other_versions():
+    assert not main.etag_matches(request_with('W/"abc-2"'), 'W/"abc-1"')
+    assert not main.etag_matches(request_with(), 'W/"abc-1"')
+    assert not main.etag_matches(request_with('W/"abc-1"'), None)
+
+
+def test_maintenance_must_be_an_object(client):
+    response = client.post("/add_maintenance", json={"meskenId": "x", "maintenance": "boya", "token": "t"})
+    assert response.status_code == 400
@@ -0,0 +1,145 @@
+import copy
+
+from bson.objectid import ObjectId
+
+from api.models import User, Mesken, SaleInfo, MaintenanceEntry
+
+
+def mesken_doc():
+    return {
+        "_id": ObjectId(),
+        "meskenId": "7",
+        "ilId": "34",
+        "parselId": "1",
+        "zeminId": "2",
+        "parselNo": "3",
+        "mahalleId": "4",
+        "adaNo": "5",
+        "ilceId": "6",
+        "katNo": "1",
+        "kapiNo": "8",
+        "rayicFiyat": "1500000",
+        "pay": "1",
+        "payda": "4",
+        "status": "2",
+        "auctionInfo": {},
+        "saleHistory": [],
+        "saleInfo": {"meskenId": "7", "price": "10", "amount": "1"},
+        "maintenanceHistory": [{"date": "2022-10-01", "desc": "boya", "price": "100"}],
+        "age": "12",
+        "tckn": "12345678901",
+        "version": 3,
+    }
+
+
+def test_mesken_bson_round_trip():
+    doc = mesken_doc()
+    mesken = Mesken.from_bson(doc)
+    assert mesken.saleInfo == SaleInfo("7", "10", "1")
+    assert mesken.maintenanceHistory == [MaintenanceEntry("2022-10-01", "boya", "100")]
+    assert mesken.to_bson() == doc
+
+
+def test_mesken_to_json_stringifies_the_id():
+    doc = mesken_doc()
+    assert Mesken.from_bson(doc).to_json()["_id"] == str(doc["_id"])
+
+
+def test_mesken_from_request_starts_empty():
+    req = {name: "1" for name in Mesken.REQUEST_FIELDS}
+    doc = Mesken.from_request(req).to_bson()
+    assert doc["saleInfo"] == {}
+    assert doc["maintenanceHistory"] == [] and doc["saleHistory"] == []
+    assert doc["version"] == 0
+    assert "_id" not in doc
+
+
+def test_mesken_projection_leaves_unfetched_fields_out():
+    doc = mesken_doc()
+    for name in Mesken.LISTING_PROJECTION:
+        del doc[name]
+    encoded = Mesken.from_bson(doc).to_bson()
+    assert "maintenanceHistory" not in encoded and "saleHistory" not in encoded
+
+
+def test_mesken_keeps_malformed_maintenance_entries(caplog):
+    doc = mesken_doc()
+    doc["maintenanceHistory"].append("legacy entry")
+    mesken = Mesken.from_bson(doc)
+    assert mesken.maintenanceHistory[1] == "legacy entry"
+    assert mesken.to_bson()["maintenanceHistory"] == doc["maintenanceHistory"]
+    assert "malformed maintenance entry" in caplog.text
+
+
+def test_mesken_listing_json_matches_the_model_path():
+    doc = mesken_doc()
+    for name in Mesken.LISTING_PROJECTION:
+        del doc[name]
+    expected = Mesken.from_bson(doc).to_json()
+    assert Mesken.listing_json(copy.deepcopy(doc)) == expected
+
+    doc["saleInfo"] = {}
+    del doc["version"]
+    assert Mesken.listing_json(copy.deepcopy(doc)) == Mesken.from_bson(doc).to_json()
+
+
+def test_user_round_trip_and_listing_json():
+    mesken_id = ObjectId()
+    doc = {
+        "_id": ObjectId(),
+        "tckn": "12345678901",
+        "publicAddress": "0xabc",
+        "name": "Ada",
+        "surname": "Lovelace",
+        "nonce": 0,
+        "meskenlerim": [{"meskenId": mesken_id, "pay": "3000"}],
+    }
+    assert User.from_bson(doc).to_bson() == doc
+    expected = User.from_bson(doc).to_json()
+    assert expected["meskenlerim"] == [{"meskenId": str(mesken_id), "pay": "3000"}]
+    assert User.listing_json(copy.deepcopy(doc)) == expected
+
+
+def test_user_from_request():
+    user = User.from_request({"tckn": "1", "password": "p", "name": "n", "surname": "s"})
+    assert user.to_bson() == {
+        "tckn": "1", "password": "p", "publicAddress": "", "name": "n", "surname": "s", "nonce": 0, "meskenlerim": [],
+    }
+
+
+def test_mesken_keeps_unknown_fields_and_stored_nulls():
+    doc = mesken_doc()
+    doc["pay"] = None
+    doc["legacyField"] = {"written": "by an older client"}
+    doc["maintenanceHistory"][0]["invoice"] = "A-1"
+    del doc["auctionInfo"]
+
+    mesken = Mesken.from_bson(doc)
+    assert mesken.extras == {"legacyField": {"written": "by an older client"}}
+    assert mesken.pay is None
+    encoded = mesken.to_bson()
+    assert encoded == doc
+    assert "auctionInfo" not in encoded and encoded["pay"] is None
+
+
+def test_mesken_detail_and_listing_have_the_same_shape():
+    doc = mesken_doc()
+    for name in Mesken.LISTING_PROJECTION:
+        del doc[name]
+    doc["tckn"] = None
+    doc["legacyField"] = 1
+    assert Mesken.from_bson(doc).to_json() == Mesken.listing_json(copy.deepcopy(doc))
+
+
+def test_user_keeps_unknown_fields_of_its_meskens():
+    mesken_id = ObjectId()
+    doc = {"_id": ObjectId(), "tckn": "1", "surname": None, "role": "admin",
+           "meskenlerim": [{"meskenId": mesken_id, "pay": "3000", "since": "2022"}]}
+    assert User.from_bson(doc).to_bson() == doc
+    assert User.from_bson(doc).to_json() == User.listing_json(copy.deepcopy(doc))
+    assert doc["meskenlerim"][0]["meskenId"] == mesken_id
+
+
+def test_maintenance_from_request_stores_only_its_fields():
+    entry = MaintenanceEntry.from_request({"date": "2022-10-01", "desc": "boya", "admin": True})
+    assert entry.to_bson() == {"date": "2022-10-01", "desc": "boya", "price": None}
@@ -0,0 +1,105 @@
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+from benchmarks.fixtures import make_mesken
+from bson import json_util
+from bson.int64 import Int64
+from bson.objectid import ObjectId
+
+from api import snapshot
+from fakes import FakeClient
+
+
+def mesken_doc():
+    # the types a client can slip past the API: ints and floats where strings are expected, stored nulls,
+    # fields outside the schema, dates and ObjectIds in nested documents
+    return {
+        "_id": ObjectId(),
+        "meskenId": "7",
+        "ilId": 34,
+        "rayicFiyat": 1500000.5,
+        "pay": None,
+        "version": Int64(3),
+        "saleInfo": {},
+        "auctionInfo": None,
+        "maintenanceHistory": [{"date": datetime(2022, 10, 1), "desc": "boya", "price": "100"}, "legacy"],
+        "tckn": "12345678901",
+        "imported": True,
+    }
+
+
+def user_doc():
+    return {
+        "_id": ObjectId(),
+        "tckn": "12345678901",
+        "nonce": 2,
+        "meskenlerim": [{"meskenId": ObjectId(), "pay": "1"}],
+    }
+
+
+def assert_same_types(left, right):
+    assert type(left) is type(right)
+    if isinstance(left, dict):
+        assert left.keys() == right.keys()
+        for key in left:
+            assert_same_types(left[key], right[key])
+    elif isinstance(left, list):
+        assert len(left) == len(right)
+        for i, j in zip(left, right):
+            assert_same_types(i, j)
+    else:
+        assert left == right
+
+
+def test_row_round_trip_keeps_types_nulls_and_extra_fields():
+    doc = mesken_doc()
+    columns = snapshot.encode_documents(snapshot.MESKEN_SCHEMA, [doc, {"_id": doc["_id"]}])
+    row = {name: cells[0] for name, cells in columns.items()}
+
+    assert row["_id"] == str(doc["_id"]) and row["meskenId"] == "7"
+    # missing, stored null and mismatched types all leave the cell empty, only _extra tells them apart
+    assert row["parselId"] is None and row["pay"] is None and row["ilId"] is None and row["version"] is None
+    assert set(json_util.loads(row["_extra"])) == {"ilId", "rayicFiyat", "pay", "version", "imported"}
+    assert_same_types(snapshot.decode_documents(snapshot.MESKEN_SCHEMA, columns), [doc, {"_id": doc["_id"]}])
+
+
+def test_scalars_are_typed_columns(tmp_path):
+    client = FakeClient()
+    client.docs = {"meskenlerim": [make_mesken(i) for i in range(3)]}
+    path = str(tmp_path / "meskenlerim.arrow")
+    snapshot.export_collection(client["db"]["meskenlerim"], path)
+
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    assert table.column("ilId").to_pylist() == [i["ilId"] for i in client.docs["meskenlerim"]]
+    assert table.column("version").type == pa.int64()
+    assert pc.sum(table.column("version")).as_py() == sum(i["version"] for i in client.docs["meskenlerim"])
+    assert table.column("_id").to_pylist() == [str(i["_id"]) for i in client.docs["meskenlerim"]]
+    assert table.column("_extra").null_count == 3
+
+
+def test_file_round_trip(tmp_path):
+    source, target = FakeClient(), FakeClient()
+    source.docs = {"meskenlerim": [mesken_doc() for _ in range(5)], "users": [user_doc()]}
+
+    for name in snapshot.SCHEMAS:
+        path = str(tmp_path / (name + ".arrow"))
+        count = snapshot.export_collection(source["db"][name], path, chunk_size=2)
+        assert count == len(source.docs[name])
+        assert snapshot.import_collection(target["db"][name], path, workers=2) == count
+
+    for name in snapshot.SCHEMAS:
+        imported = sorted(target.docs[name], key=lambda i: i["_id"])
+        assert_same_types(imported, sorted(source.docs[name], key=lambda i: i["_id"]))
+
+
+def test_import_rejects_another_schema(tmp_path):
+    client = FakeClient()
+    client.docs = {"users": [user_doc()]}
+    path = str(tmp_path / "users.arrow")
+    snapshot.export_collection(client["db"]["users"], path)
+
+    with pytest.raises(ValueError):
+        snapshot.import_collection(client["db"]["meskenlerim"], path)